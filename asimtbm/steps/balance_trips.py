@@ -1,7 +1,12 @@
 import logging
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import pandas as pd
 
-from asimtbm.utils.matrix_balancer import Balancer
+from asimtbm.utils.matrix_balancer import Balancer, IPF_METHOD
 
 from activitysim.core import (
     inject,
@@ -10,13 +15,20 @@ from activitysim.core import (
     pipeline
 )
 
+from asimtbm.utils import cache
 from asimtbm.utils import tracing as trace
+from asimtbm.utils import zone_registry
 
 logger = logging.getLogger(__name__)
 
 YAML_FILENAME = 'balance_trips.yaml'
 DEST_TARGETS = 'dest_zone_trip_targets'
 ORIG_TARGETS = 'orig_zone_trip_targets'
+SPARSE_KEY = 'sparse_balancing'
+METHOD_KEY = 'balance_method'
+THREADS_KEY = 'balance_threads'
+WARM_START_KEY = 'warm_start_balancing'
+FACTORS_CACHE_DIR = 'balancing'
 
 
 @inject.step()
@@ -40,6 +52,15 @@ def balance_trips(zones, trace_od):
     max_iterations: maximum number of iteration to pass to the balancer
     balance_closure: float precision to stop balancing totals
     input_table: path to CSV to use instead of trips table.
+    sparse_balancing: True to balance only the nonzero trips, for
+        mostly empty trip tables. See Balancer.
+    balance_method: 'ipf' (default) or 'anderson' to accelerate
+        convergence. See Balancer.
+    balance_threads: number of segments balanced at once when every
+        target is given per segment. See balance_segments.
+    warm_start_balancing: True to save the balancing factors in the
+        cache directory and start the next run from them, if its zones
+        and segments are the same. See run_balancer.
 
     The config file can also have an orig_zone_trip_targets to manually
     specify origin zone totals instead of using the logsums calculated by
@@ -50,7 +71,7 @@ def balance_trips(zones, trace_od):
     zones : DataFrameWrapper
         zone attributes
     trace_od : list or dict
-
+        origin-destination pairs to trace, see tracing.parse_trace_od
 
     Returns
     -------
@@ -62,16 +83,20 @@ def balance_trips(zones, trace_od):
     model_settings = config.read_model_settings(YAML_FILENAME)
 
     trips_df = get_trips_df(model_settings)
-    trace_rows = trace.trace_filter(trips_df, trace_od)
-    tracing.write_csv(trips_df[trace_rows],
-                      file_name='trips_unbalanced',
-                      transpose=False)
+    write_trace(trips_df, trace_od, 'trips_unbalanced')
+    od_index = trips_df.index
+    segments = trips_df.columns
 
-    trips_df = trips_df.melt(
+    trips_df = trips_df.reset_index().melt(
                 id_vars=['orig', 'dest'],
                 var_name='segment',
                 value_name='trips')
 
+    sparse = model_settings.get(SPARSE_KEY, False)
+    if sparse:
+        # balancing never changes zero trips
+        trips_df = trips_df[trips_df['trips'] != 0]
+
     dest_targets = model_settings.get(DEST_TARGETS)
     orig_targets = model_settings.get(ORIG_TARGETS)
     max_iterations = model_settings.get('max_iterations', 50)
@@ -82,38 +107,198 @@ def balance_trips(zones, trace_od):
                                                   dest_targets,
                                                   orig_targets)
 
-    balancer = Balancer(trips_df.reset_index(),
-                        aggregates,
-                        dimensions,
-                        weight_col='trips',
-                        max_iteration=max_iterations,
-                        closure=closure)
-    balanced_df = balancer.balance()
+    balancer_settings = {
+        'max_iteration': max_iterations,
+        'closure': closure,
+        'sparse': sparse,
+        'method': model_settings.get(METHOD_KEY, IPF_METHOD),
+    }
 
-    balanced_trips = balanced_df.set_index(['orig', 'dest', 'segment'])['trips'].unstack()
-    tracing.write_csv(balanced_trips.reset_index()[trace_rows],
-                      file_name='trips_balanced',
-                      transpose=False)
+    warm_start = model_settings.get(WARM_START_KEY, False)
+
+    if all('segment' in features for features in dimensions):
+        num_threads = model_settings.get(THREADS_KEY, min(len(segments), os.cpu_count() or 1))
+        balanced_df = balance_segments(trips_df, aggregates, dimensions, num_threads,
+                                       balancer_settings, warm_start)
+    else:
+        balanced_df = run_balancer(trips_df.reset_index(), aggregates, dimensions, 'trips',
+                                   balancer_settings, warm_start)
+
+    balanced_trips = balanced_df.set_index(['orig', 'dest', 'segment'])['trips'] \
+        .unstack(fill_value=0)
+    if sparse:
+        balanced_trips = balanced_trips.reindex(index=od_index.sort_values(),
+                                                columns=segments.sort_values().rename('segment'),
+                                                fill_value=0)
+    write_trace(balanced_trips, trace_od, 'trips_balanced')
     pipeline.replace_table('trips', balanced_trips)
 
     logger.info('finished balancing trips.')
 
 
+@zone_registry.register_zone_columns('balance_trips', YAML_FILENAME)
+def zone_columns(model_settings):
+    """Zone table columns used by this step
+
+    Parameters
+    ----------
+    model_settings : dict
+
+    Returns
+    -------
+    set of column names
+    """
+    columns = set()
+    for targets in [model_settings.get(DEST_TARGETS), model_settings.get(ORIG_TARGETS)]:
+        columns.update((targets or {}).values())
+
+    return columns
+
+
 def get_trips_df(model_settings):
     """Default to pipeline trips table unless
     user provides a CSV
+
+    Returns
+    -------
+    pandas DataFrame indexed by orig, dest
     """
     filename = model_settings.get('input_table', None)
 
     if not filename:
         logger.info("using 'trips' pipeline table for balancing step")
         trips_df = pipeline.get_table('trips')
-        return trips_df.reset_index()
+        return trips_df.reset_index().set_index(['orig', 'dest'])
 
     logger.info('using %s for balancing step' % filename)
     fpath = config.data_file_path(filename, mandatory=True)
 
-    return pd.read_csv(fpath, header=0, comment='#')
+    return pd.read_csv(fpath, header=0, comment='#').set_index(['orig', 'dest'])
+
+
+def write_trace(trips_df, trace_od, file_name):
+    """Write the trace_od rows of a trips table indexed by orig, dest"""
+    trace_rows = trace.trace_locs(trips_df.index, trace_od)
+    if trace_rows is None:
+        return
+
+    tracing.write_csv(trips_df.iloc[trace_rows].reset_index(),
+                      file_name=file_name,
+                      transpose=False)
+
+
+def balance_segments(trips_df, aggregates, dimensions, num_threads, balancer_settings,
+                     warm_start=False):
+    """Balance each segment separately, in parallel threads
+
+    When every aggregate is given by segment, no target links the
+    segments, so each is balanced on its own matrix. Each segment then
+    stops iterating once it converges itself, rather than when all
+    segments have. numpy releases the GIL for the array operations,
+    so segments balance in parallel.
+
+    Parameters
+    ----------
+    trips_df : pandas DataFrame
+        with orig, dest, segment and trips columns
+    aggregates : list of pandas Series
+        indexed by a level and segment
+    dimensions : list of lists of column names that match aggregates
+    num_threads : int
+    balancer_settings : dict
+        Balancer keyword arguments
+    warm_start : bool
+        see run_balancer
+
+    Returns
+    -------
+    pandas DataFrame like trips_df with balanced trips
+    """
+    segment_dimensions = [[f for f in features if f != 'segment'] for features in dimensions]
+    segment_rows = trips_df.groupby('segment', sort=False).indices
+    od_trips_df = trips_df[['orig', 'dest', 'trips']]
+
+    def balance(segment):
+        segment_aggregates = [aggregate.xs(segment, level='segment') for aggregate in aggregates]
+
+        balanced_df = run_balancer(od_trips_df.iloc[segment_rows[segment]].reset_index(drop=True),
+                                   segment_aggregates,
+                                   segment_dimensions,
+                                   '%s_trips' % segment,
+                                   balancer_settings,
+                                   warm_start)
+        return balanced_df['trips'].values
+
+    segments = list(segment_rows)
+    logger.info('balancing %s segments separately in %s threads' % (len(segments), num_threads))
+
+    if num_threads > 1 and len(segments) > 1:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            balanced = list(executor.map(balance, segments))
+    else:
+        balanced = [balance(segment) for segment in segments]
+
+    trips = trips_df['trips'].values.astype(np.float64)
+    for segment, segment_trips in zip(segments, balanced):
+        trips[segment_rows[segment]] = segment_trips
+
+    balanced_df = trips_df.copy(deep=False)
+    balanced_df['trips'] = trips
+
+    return balanced_df
+
+
+def run_balancer(df, aggregates, dimensions, trace_label, balancer_settings, warm_start=False):
+    """Balance the trips column of df
+
+    With warm_start, the balancing factors are saved in the cache
+    directory under trace_label, and the next balance with the same
+    trace_label starts from them. Scenarios that change the targets
+    only a little then converge in a few iterations. Saved factors are
+    only used if the zones and segments of the aggregates are the same.
+
+    Parameters
+    ----------
+    df : pandas DataFrame
+        with the trips column and the columns of dimensions
+    aggregates : list of pandas Series
+    dimensions : list of lists of column names that match aggregates
+    trace_label : str
+    balancer_settings : dict
+        Balancer keyword arguments
+    warm_start : bool
+
+    Returns
+    -------
+    balanced pandas DataFrame
+    """
+    factors_path = None
+    initial_factors = None
+    if warm_start:
+        factors_path = os.path.join(cache.cache_dir(FACTORS_CACHE_DIR),
+                                    '%s_factors.pkl' % trace_label)
+        if os.path.isfile(factors_path):
+            try:
+                with open(factors_path, 'rb') as f:
+                    initial_factors = pickle.load(f)
+            except Exception as err:
+                logger.warning('could not read balancing factors %s: %s' % (factors_path, err))
+
+    balancer = Balancer(df,
+                        aggregates,
+                        dimensions,
+                        weight_col='trips',
+                        trace_label=trace_label,
+                        initial_factors=initial_factors,
+                        **balancer_settings)
+    balanced_df = balancer.balance()
+
+    if factors_path:
+        factors = balancer.balancing_factors()
+        cache.write_atomic(factors_path,
+                           lambda f: pickle.dump(factors, f, protocol=pickle.HIGHEST_PROTOCOL))
+
+    return balanced_df
 
 
 def calculate_aggregates(df, zones, dest_targets, orig_targets=None):
@@ -1,5 +1,9 @@
+import hashlib
 import logging
-from os import path
+import multiprocessing
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 import numpy as np
@@ -12,14 +16,36 @@ from activitysim.core import (
     tracing,
 )
 
+from asimtbm.utils import cache
+from asimtbm.utils import dense
+from asimtbm.utils import expressions
 from asimtbm.utils import skims
+from asimtbm.utils import sparse
 from asimtbm.utils import trips
 from asimtbm.utils import tracing as trace
+from asimtbm.utils import zone_registry
 
 logger = logging.getLogger(__name__)
 
 YAML_FILENAME = 'destination_choice.yaml'
 ORIGIN_TRIPS_KEY = 'orig_zone_trips'
+ENGINE_KEY = 'engine'
+LONG_ENGINE = 'long'
+DENSE_ENGINE = 'dense'
+CHUNK_SIZE_KEY = 'chunk_size'
+MAX_MEMORY_KEY = 'max_memory_mb'
+NUM_PROCESSES_KEY = 'num_processes'
+UTILITY_DTYPE_KEY = 'utility_dtype'
+CHOICE_SET_KEY = 'choice_set'
+SAMPLE_KEY = 'sample'
+OD_CACHE_KEY = 'cache_od_table'
+OD_CACHE_DIR = 'od_tables'
+SCENARIOS_KEY = 'coefficient_scenarios'
+SCENARIO_THREADS_KEY = 'scenario_threads'
+SCENARIO_OUTPUTS = ['scenario_trips', 'scenario_logsums']
+
+# outputs with a row for every zone, summed over blocks of origin zones
+SUMMED_OUTPUTS = ['dest_summary']
 
 
 @inject.step()
@@ -37,6 +63,49 @@ def destination_choice(zones, data_dir, trace_od):
         - dest_zone: <list of destination zone attribute columns>
         - orig_zone_trips: <dict of num trips for each segment>
 
+    and optionally:
+
+        - engine: 'long' (default) evaluates expressions on a long-format
+          OD table. 'dense' evaluates them on 2D orig x dest arrays and
+          only builds the long-format tables for the pipeline outputs.
+          The dense engine compiles the spec once into a cached plan.
+        - chunk_size: number of origin zones to evaluate at once
+        - max_memory_mb: approximate working memory per chunk of origin
+          zones, used to derive chunk_size. Specify at most one of these.
+        - num_processes: number of worker processes to evaluate blocks of
+          origin zones in parallel
+        - utility_dtype: 'float64' (default) or 'float32' for utility,
+          logit and trips calculations
+        - choice_set: dense engine only. prunes the destinations of each
+          origin before evaluating the spec, see sparse.choice_set:
+            - available: <expression, e.g. dest_zone['totemp'] > 0>
+            - distance: <expression, e.g. skims['DIST']>
+            - max_distance: <number>
+            - nearest: <number of closest destinations to keep>
+          od_table and trips then only hold the pairs in the choice set.
+        - sample: dense engine only. evaluates the spec only on an
+          importance sample of destinations for each origin, with a
+          sampling correction, see sparse.sample_destinations:
+            - size: <number of draws per origin>
+            - proposal: <expression, e.g. dest_zone['totemp'] * np.exp(-0.1 * skims['DIST'])>
+            - seed: <random seed, default 0>
+          od_table and trips then only hold the sampled pairs.
+        - cache_od_table: True to cache the evaluated expressions of each
+          block of origin zones between runs. A rerun that only changes
+          segment coefficients skips reading skims and evaluating
+          expressions.
+        - coefficient_scenarios: csv file name or dict of alternative
+          segment coefficients, see read_coefficient_scenarios. The trips
+          and logsums of every scenario are calculated from the same
+          evaluated expressions and registered as the scenario_trips and
+          scenario_logsums tables, indexed by scenario.
+        - scenario_threads: number of threads calculating scenarios
+
+    Besides the od_table, zone_summary (od_table summed by origin) and
+    trips tables, the od_table summed by destination is registered as
+    the dest_summary table and the per-origin logsum of each segment as
+    the logsums table.
+
     @inject.step before the method definition registers this step with the pipeline.
 
     Parameters
@@ -44,7 +113,7 @@ def destination_choice(zones, data_dir, trace_od):
     zones : pandas DataFrame of zone attributes
     data_dir :  str, data directory path
     trace_od : list or dict
-        origin-destination pair to trace.
+        origin-destination pairs to trace, see tracing.parse_trace_od
 
     Returns
     -------
@@ -55,31 +124,716 @@ def destination_choice(zones, data_dir, trace_od):
     logger.info('running destination choice step ...')
 
     model_settings = config.read_model_settings(YAML_FILENAME)
+    engine = model_settings.get(ENGINE_KEY, LONG_ENGINE)
+    if engine not in [LONG_ENGINE, DENSE_ENGINE]:
+        raise RuntimeError("%s must be one of %s" % (ENGINE_KEY, [LONG_ENGINE, DENSE_ENGINE]))
+    for key in [CHOICE_SET_KEY, SAMPLE_KEY]:
+        if model_settings.get(key) and engine != DENSE_ENGINE:
+            raise RuntimeError("%s requires %s: %s" % (key, ENGINE_KEY, DENSE_ENGINE))
+    if model_settings.get(CHOICE_SET_KEY) and model_settings.get(SAMPLE_KEY):
+        raise RuntimeError("specify only one of %s and %s" % (CHOICE_SET_KEY, SAMPLE_KEY))
+
+    zones_df = zones.to_frame()
     locals_dict = create_locals_dict(model_settings)
 
-    od_index = create_od_index(zones.to_frame())
+    segments = model_settings.get(ORIGIN_TRIPS_KEY)
+    spec = read_spec_file(model_settings, segments)
+    plan = expressions.load_spec_plan(spec)
+    scenarios = read_coefficient_scenarios(model_settings, spec, segments)
 
-    skims_dict = skims.read_skims(zones.index, data_dir, model_settings)
-    locals_dict.update(skims_dict)
+    references = spec_references(plan, model_settings)
+    check_zone_references(references, model_settings)
 
-    zone_matrices = create_zone_matrices(zones.to_frame(), od_index, model_settings)
-    locals_dict.update(zone_matrices)
+    od_cache_key = None
+    if model_settings.get(OD_CACHE_KEY, False):
+        od_cache_key = get_od_cache_key(engine, spec, zones_df, references, data_dir,
+                                        model_settings, trace_od)
 
-    segments = model_settings.get(ORIGIN_TRIPS_KEY)
-    spec = read_spec_file(model_settings, segments)
+    num_processes = model_settings.get(NUM_PROCESSES_KEY, 1)
+    chunk_size = get_chunk_size(model_settings, len(zones_df.index), spec, segments,
+                                num_processes=num_processes)
+    blocks = origin_blocks(len(zones_df.index), chunk_size)
 
-    od_table = create_od_table(od_index, spec, locals_dict, trace_od)
-    trips.calculate_num_trips(od_table, zones, spec, locals_dict,
-                              segments, trace_od=trace_od)
+    # skims are only needed for blocks that are not cached
+    skims_dict = skims.read_skims(zones.index, data_dir, model_settings,
+                                  dense=engine == DENSE_ENGINE,
+                                  references=references,
+                                  prefetch=not all_blocks_cached(od_cache_key, blocks))
+
+    context = {
+        'engine': engine,
+        'zones': zones_df,
+        'spec': spec,
+        'plan': plan,
+        'references': references,
+        'locals_dict': locals_dict,
+        'skims_dict': skims_dict,
+        'segments': segments,
+        'model_settings': model_settings,
+        'trace_od': trace_od,
+        'od_cache_key': od_cache_key,
+        'scenarios': scenarios,
+    }
+
+    outputs = OrderedDict()
+    traces = OrderedDict()
+    for i, (block_outputs, block_traces) in enumerate(map_blocks(blocks, context,
+                                                                 num_processes)):
+        logger.info('finished origin zone block %s of %s' % (i + 1, len(blocks)))
+
+        for name, df in block_outputs.items():
+            outputs.setdefault(name, []).append(df)
+        for name, df in block_traces.items():
+            traces.setdefault(name, []).append(df)
+
+    for file_name, dfs in traces.items():
+        tracing.write_csv(pd.concat(dfs), file_name=file_name, transpose=False)
+
+    for name, dfs in outputs.items():
+        logger.info('registering %s to pipeline ...' % name)
+        if name in SUMMED_OUTPUTS:
+            df = dfs[0]
+            for block_df in dfs[1:]:
+                df = df + block_df
+        else:
+            df = pd.concat(dfs) if len(dfs) > 1 else dfs[0]
+        if name in SCENARIO_OUTPUTS and len(dfs) > 1:
+            df = scenario_major(df, scenarios)
+        pipeline.replace_table(name, df)
 
     # This step is not strictly necessary since the pipeline
     # closes remaining open files on exit. This just closes them
     # now instead of leaving them open consuming memory for subsequent steps.
-    skims.close_skims(locals_dict)
+    skims.close_skims(skims_dict)
 
     logger.info('finished destination choice step.')
 
 
+@zone_registry.register_zone_columns('destination_choice', YAML_FILENAME)
+def zone_columns(model_settings):
+    """Zone table columns used by this step
+
+    Parameters
+    ----------
+    model_settings : dict
+
+    Returns
+    -------
+    set of column names
+    """
+    columns = set(model_settings.get('dest_zone') or [])
+    columns.update(model_settings.get('orig_zone') or [])
+    columns.update((model_settings.get(ORIGIN_TRIPS_KEY) or {}).values())
+
+    return columns
+
+
+def spec_references(plan, model_settings):
+    """String keys the spec, choice set and sample expressions subscript each name with
+
+    Parameters
+    ----------
+    plan : expressions.SpecPlan
+    model_settings : dict
+
+    Returns
+    -------
+    dict of name: set of keys, e.g. {'skims': {'mf3'}, 'dest_zone': {'totemp'}},
+    for every name the expressions read
+    """
+    choice_set = model_settings.get(CHOICE_SET_KEY) or {}
+    sample = model_settings.get(SAMPLE_KEY) or {}
+    pair_expressions = [choice_set.get(sparse.AVAILABLE_KEY),
+                        choice_set.get(sparse.DISTANCE_KEY),
+                        sample.get(sparse.PROPOSAL_KEY)]
+    pair_references, pair_names = \
+        expressions.expression_references([e for e in pair_expressions if e])
+
+    # names used other than by subscript, e.g. passed to a function, have no keys
+    references = {name: set() for name in plan.names + pair_names}
+    for found in [plan.references, pair_references]:
+        for name, keys in found.items():
+            references[name].update(keys)
+
+    return references
+
+
+def check_zone_references(references, model_settings):
+    """Raise an error naming any zone attributes the expressions use
+    that are not listed under dest_zone or orig_zone in model settings
+    """
+    missing = []
+    for local_name in ['dest_zone', 'orig_zone']:
+        columns = model_settings.get(local_name) or []
+        missing.extend("%s['%s']" % (local_name, key)
+                       for key in sorted(references.get(local_name, []))
+                       if key not in columns)
+
+    if missing:
+        raise RuntimeError("expressions reference zone attributes %s not listed in %s"
+                           % (missing, YAML_FILENAME))
+
+
+def evaluate_block(rows, context):
+    """Run the configured engine for a block of origin zones
+
+    Parameters
+    ----------
+    rows : slice
+        origin zone positions
+    context : dict
+        engine, zones, spec, plan, locals_dict, skims_dict, segments,
+        model_settings, trace_od, od_cache_key and scenarios shared by
+        all blocks
+
+    Returns
+    -------
+    outputs : OrderedDict
+        pipeline table name: block DataFrame
+    traces : OrderedDict
+        trace file name: block DataFrame
+    """
+    block_locals = dict(context['locals_dict'])
+    block_locals.update(skims.skims_block(context['skims_dict'], rows))
+
+    args = (rows, context['zones'], context['spec'], block_locals,
+            context['segments'], context['model_settings'], context['trace_od'])
+
+    kwargs = {
+        'od_cache': od_cache_path(context['od_cache_key'], rows),
+        'scenarios': context['scenarios'],
+    }
+
+    if context['engine'] == DENSE_ENGINE and (context['model_settings'].get(CHOICE_SET_KEY) or
+                                              context['model_settings'].get(SAMPLE_KEY)):
+        return evaluate_sparse_block(*args, plan=context['plan'], **kwargs)
+
+    if context['engine'] == DENSE_ENGINE:
+        return evaluate_dense_block(*args, plan=context['plan'], **kwargs)
+
+    return evaluate_long_block(*args, **kwargs)
+
+
+def get_od_cache_key(engine, spec, zones, references, data_dir, model_settings, trace_od):
+    """Hash of everything the evaluated expressions depend on
+
+    That is the spec targets and expressions, constants, the zone
+    attributes, the omx files of the skims the expressions use (by
+    content) and their skim_dtypes, the choice set or sample and trace_od. Segment coefficients are
+    not included, so changing them reuses the cached expressions.
+
+    Returns
+    -------
+    str
+    """
+    h = hashlib.sha256()
+
+    def update(value):
+        h.update(repr(value).encode('utf-8'))
+        h.update(b'\0')
+
+    update(engine)
+    update(expressions.spec_hash(spec))
+    update(sorted(config.get_model_constants(model_settings).items()))
+    update(model_settings.get('numpy'))
+    update(model_settings.get(CHOICE_SET_KEY))
+    update(model_settings.get(SAMPLE_KEY))
+    update(trace_od)
+
+    for local_name in ['dest_zone', 'orig_zone']:
+        columns = model_settings.get(local_name) or []
+        update((local_name, columns))
+        h.update(pd.util.hash_pandas_object(zones[columns], index=True).values.tobytes())
+    update(list(zones.index))
+
+    skim_dtypes = model_settings.get(skims.SKIM_DTYPES_KEY) or {}
+    for local_name, omx_file_name in model_settings.get(skims.SKIMS_KEY).items():
+        if local_name in references:
+            dtypes = sorted((key, str(dtype)) for key, dtype in skim_dtypes.items()
+                            if key in references[local_name])
+            update((local_name, sorted(references[local_name]), dtypes,
+                    cache.cached_file_digest(os.path.join(data_dir, omx_file_name))))
+
+    return h.hexdigest()
+
+
+def od_cache_path(od_cache_key, rows):
+    """Cache file for the evaluated expressions of a block or None"""
+    if not od_cache_key:
+        return None
+
+    file_name = '%s-%s-%s.pkl' % (od_cache_key, rows.start, rows.stop)
+    return os.path.join(cache.cache_dir(OD_CACHE_DIR), file_name)
+
+
+def all_blocks_cached(od_cache_key, blocks):
+    """Whether the evaluated expressions of every block are cached"""
+    return all(os.path.isfile(od_cache_path(od_cache_key, rows) or '') for rows in blocks)
+
+
+# block context inherited by forked worker processes, so skims and zone
+# attributes are shared with the workers rather than pickled for each block
+_worker_context = None
+
+
+def _evaluate_block_in_worker(rows):
+    return evaluate_block(rows, _worker_context)
+
+
+def map_blocks(blocks, context, num_processes=1):
+    """Evaluate blocks of origin zones, in parallel if num_processes > 1
+
+    Workers are forked from this process and inherit the skims and
+    zone attributes. Skims used by the spec are read here first and kept
+    in memory regardless of max_skim_memory_mb, so workers never read
+    from the omx files themselves, see skims.pin_skims. Results are
+    yielded in block order.
+
+    Parameters
+    ----------
+    blocks : list of slices
+    context : dict
+        see evaluate_block
+    num_processes : int
+
+    Returns
+    -------
+    generator of (outputs, traces) for each block
+    """
+    if num_processes > 1 and len(blocks) > 1 \
+            and 'fork' not in multiprocessing.get_all_start_methods():
+        logger.warning('%s requires fork, which is not available on this platform. '
+                       'evaluating origin zone blocks serially.' % NUM_PROCESSES_KEY)
+        num_processes = 1
+
+    if num_processes <= 1 or len(blocks) <= 1:
+        for rows in blocks:
+            yield evaluate_block(rows, context)
+        return
+
+    if not all_blocks_cached(context['od_cache_key'], blocks):
+        logger.info('reading skims before starting %s processes ...' % num_processes)
+        skims.pin_skims(context['skims_dict'], context['references'])
+
+    # threads do not survive fork, so reads in progress must finish first
+    skims.wait_skims(context['skims_dict'])
+
+    global _worker_context
+    _worker_context = context
+    try:
+        with multiprocessing.get_context('fork').Pool(num_processes) as pool:
+            for result in pool.imap(_evaluate_block_in_worker, blocks):
+                yield result
+    finally:
+        _worker_context = None
+
+
+def evaluate_long_block(rows, zones, spec, locals_dict, segments, model_settings, trace_od,
+                        od_cache=None, scenarios=None):
+    """Run the long-format engine for a block of origin zones
+
+    Parameters
+    ----------
+    rows : slice
+        origin zone positions
+    zones : pandas DataFrame
+    spec : pandas DataFrame, assignment expressions
+    locals_dict : dict
+        dictionary containing constants and skims
+    segments : dict, origin zone trip segments
+    model_settings : dict
+    trace_od : list or dict, origin-destination pairs to trace
+    od_cache : str, optional
+        cache file for the evaluated expressions
+    scenarios : OrderedDict, optional
+        scenario name: spec with the scenario's coefficients
+
+    Returns
+    -------
+    outputs : OrderedDict
+        pipeline table name: block DataFrame
+    traces : OrderedDict
+        trace file name: block DataFrame
+    """
+    od_index = create_od_index(zones, orig_rows=rows)
+
+    zone_matrices = create_zone_matrices(zones, od_index, model_settings)
+    locals_dict.update(zone_matrices)
+
+    od_table, od_trace = cache.load_or_evaluate(
+        od_cache, lambda: create_od_table(od_index, spec, locals_dict, trace_od))
+    trips_df, logsums, trips_traces = trips.calculate_num_trips(od_table, zones.iloc[rows], spec,
+                                                                locals_dict, segments,
+                                                                trace_od=trace_od,
+                                                                dtype=utility_dtype(model_settings))
+
+    orig_index = zones.index[rows]
+    outputs = OrderedDict([
+        ('od_table', od_table),
+        ('zone_summary', create_zone_summary(od_table, orig_index, zones.index)),
+        ('dest_summary', create_dest_summary(od_table, orig_index, zones.index)),
+        ('trips', trips_df),
+        ('logsums', logsums),
+    ])
+
+    if scenarios:
+        def calculate(scenario_spec):
+            return trips.calculate_num_trips(od_table, zones.iloc[rows], scenario_spec,
+                                             locals_dict, segments,
+                                             dtype=utility_dtype(model_settings))[:2]
+
+        outputs.update(evaluate_scenarios(scenarios, calculate, model_settings))
+
+    traces = OrderedDict()
+    if od_trace is not None:
+        traces['od_table'] = od_trace
+    traces.update(trips_traces)
+
+    return outputs, traces
+
+
+def evaluate_dense_block(rows, zones, spec, locals_dict, segments, model_settings, trace_od,
+                         plan=None, od_cache=None, scenarios=None):
+    """Run the dense engine for a block of origin zones
+
+    Parameters
+    ----------
+    rows : slice
+        origin zone positions
+    zones : pandas DataFrame
+    spec : pandas DataFrame, assignment expressions
+    locals_dict : dict
+        dictionary containing constants and skims
+    segments : dict, origin zone trip segments
+    model_settings : dict
+    trace_od : list or dict, origin-destination pairs to trace
+    plan : expressions.SpecPlan, optional
+        compiled spec
+    od_cache : str, optional
+        cache file for the evaluated expressions
+    scenarios : OrderedDict, optional
+        scenario name: spec with the scenario's coefficients
+
+    Returns
+    -------
+    outputs : OrderedDict
+        pipeline table name: block DataFrame
+    traces : OrderedDict
+        trace file name: block DataFrame
+    """
+    orig_zones = zones.iloc[rows]
+    od_index = create_od_index(zones, orig_rows=rows)
+
+    zone_vectors = create_zone_vectors(zones, model_settings, orig_rows=rows)
+    locals_dict.update(zone_vectors)
+
+    trace_pairs = trace.trace_positions(orig_zones.index, zones.index, trace_od)
+
+    od_arrays, od_trace = cache.load_or_evaluate(
+        od_cache, lambda: create_od_arrays(orig_zones.index, zones.index, spec,
+                                           locals_dict, trace_pairs, plan=plan))
+    trips_dict, logsums, trips_traces = trips.calculate_dense_trips(
+        od_arrays, orig_zones, spec, locals_dict, segments,
+        trace_pairs=trace_pairs, dtype=utility_dtype(model_settings))
+
+    outputs = OrderedDict([
+        ('od_table', dense.to_long(od_arrays, od_index)),
+        ('zone_summary', dense.sum_by_orig(od_arrays, orig_zones.index)),
+        ('dest_summary', dense.sum_by_dest(od_arrays, zones.index)),
+        ('trips', dense.to_long(trips_dict, od_index)),
+        ('logsums', logsums),
+    ])
+
+    if scenarios:
+        def calculate(scenario_spec):
+            scenario_trips, scenario_logsums, _ = trips.calculate_dense_trips(
+                od_arrays, orig_zones, scenario_spec, locals_dict, segments,
+                dtype=utility_dtype(model_settings))
+            return dense.to_long(scenario_trips, od_index), scenario_logsums
+
+        outputs.update(evaluate_scenarios(scenarios, calculate, model_settings))
+
+    traces = OrderedDict()
+    if od_trace is not None:
+        traces['od_table'] = od_trace
+    for file_name, trace_results in trips_traces.items():
+        traces[file_name] = trace.trace_frame(trace_pairs, orig_zones.index, zones.index,
+                                              trace_results)
+
+    return outputs, traces
+
+
+def evaluate_sparse_block(rows, zones, spec, locals_dict, segments, model_settings, trace_od,
+                          plan=None, od_cache=None, scenarios=None):
+    """Run the dense engine on the choice set or sampled destinations
+    of a block of origin zones
+
+    The choice set or sample is found on dense orig x dest arrays, then
+    the spec is evaluated only for its pairs, with skims and zone
+    attributes gathered for each pair.
+
+    Parameters
+    ----------
+    rows : slice
+        origin zone positions
+    zones : pandas DataFrame
+    spec : pandas DataFrame, assignment expressions
+    locals_dict : dict
+        dictionary containing constants and skims
+    segments : dict, origin zone trip segments
+    model_settings : dict
+    trace_od : list or dict, origin-destination pairs to trace
+    plan : expressions.SpecPlan, optional
+        compiled spec
+    od_cache : str, optional
+        cache file for the evaluated expressions
+    scenarios : OrderedDict, optional
+        scenario name: spec with the scenario's coefficients
+
+    Returns
+    -------
+    outputs : OrderedDict
+        pipeline table name: block DataFrame
+    traces : OrderedDict
+        trace file name: block DataFrame
+    """
+    orig_zones = zones.iloc[rows]
+    shape = (len(orig_zones.index), len(zones.index))
+
+    def evaluate():
+        dense_locals = dict(locals_dict)
+        dense_locals.update(create_zone_vectors(zones, model_settings, orig_rows=rows))
+        if model_settings.get(SAMPLE_KEY):
+            pairs, correction = sparse.sample_destinations(dense_locals,
+                                                           model_settings[SAMPLE_KEY],
+                                                           orig_zones.index, shape)
+        else:
+            pairs = sparse.choice_set(dense_locals, model_settings[CHOICE_SET_KEY], shape)
+            correction = None
+
+        pair_locals = dict(locals_dict)
+        pair_locals.update(skims.skims_pairs(locals_dict, pairs.orig_pos, pairs.dest_pos))
+        pair_locals.update(create_zone_values(zones, model_settings, pairs, orig_rows=rows))
+
+        # trace the traced pairs that are in the choice set or sample
+        trace_pairs = trace.trace_positions(orig_zones.index, zones.index, trace_od)
+        od_pairs = None
+        if trace_pairs is not None:
+            pair_num = pairs.lookup(*trace_pairs)
+            trace_pairs = (pair_num, ) if len(pair_num) else None
+            od_pairs = (pairs.orig_pos[pair_num], pairs.dest_pos[pair_num])
+
+        logger.info('creating OD arrays for %s od pairs ...' % pairs.nnz)
+        od_arrays, od_trace = dense.evaluate_expressions(spec, pair_locals, (pairs.nnz, ),
+                                                         trace_pairs=trace_pairs, plan=plan)
+
+        return pairs, correction, trace_pairs, od_pairs, od_arrays, od_trace
+
+    pairs, correction, trace_pairs, od_pairs, od_arrays, od_trace = \
+        cache.load_or_evaluate(od_cache, evaluate)
+
+    trips_dict, logsums, trips_traces = trips.calculate_dense_trips(
+        od_arrays, orig_zones, spec, locals_dict, segments,
+        trace_pairs=trace_pairs, dtype=utility_dtype(model_settings), pairs=pairs,
+        correction=correction)
+
+    od_index = pairs.od_index(orig_zones.index, zones.index)
+    outputs = OrderedDict([
+        ('od_table', dense.to_long(od_arrays, od_index)),
+        ('zone_summary', sparse.sum_by_orig(od_arrays, pairs, orig_zones.index)),
+        ('dest_summary', sparse.sum_by_dest(od_arrays, pairs, zones.index)),
+        ('trips', dense.to_long(trips_dict, od_index)),
+        ('logsums', logsums),
+    ])
+
+    if scenarios:
+        def calculate(scenario_spec):
+            scenario_trips, scenario_logsums, _ = trips.calculate_dense_trips(
+                od_arrays, orig_zones, scenario_spec, locals_dict, segments,
+                dtype=utility_dtype(model_settings), pairs=pairs, correction=correction)
+            return dense.to_long(scenario_trips, od_index), scenario_logsums
+
+        outputs.update(evaluate_scenarios(scenarios, calculate, model_settings))
+
+    traces = OrderedDict()
+    if od_trace is not None:
+        traces['od_table'] = trace.trace_frame(od_pairs, orig_zones.index, zones.index,
+                                               od_trace)
+    for file_name, trace_results in trips_traces.items():
+        traces[file_name] = trace.trace_frame(od_pairs, orig_zones.index, zones.index,
+                                              trace_results)
+
+    return outputs, traces
+
+
+def evaluate_scenarios(scenarios, calculate, model_settings):
+    """Trips and logsums of each coefficient scenario for a block of origin zones
+
+    Parameters
+    ----------
+    scenarios : OrderedDict
+        scenario name: spec with the scenario's coefficients
+    calculate : callable
+        returns (trips DataFrame, logsums DataFrame) for a spec
+    model_settings : dict
+
+    Returns
+    -------
+    OrderedDict of scenario_trips and scenario_logsums DataFrames
+        indexed by scenario and the index of calculate's results
+    """
+    num_threads = model_settings.get(SCENARIO_THREADS_KEY, 1)
+
+    logger.info('calculating trips for %s coefficient scenarios ...' % len(scenarios))
+    if num_threads > 1:
+        with ThreadPoolExecutor(num_threads) as executor:
+            results = list(executor.map(calculate, scenarios.values()))
+    else:
+        results = [calculate(scenario_spec) for scenario_spec in scenarios.values()]
+
+    names = list(scenarios.keys())
+    return OrderedDict([
+        ('scenario_trips', pd.concat([r[0] for r in results], keys=names, names=['scenario'])),
+        ('scenario_logsums', pd.concat([r[1] for r in results], keys=names, names=['scenario'])),
+    ])
+
+
+def scenario_major(df, scenarios):
+    """Reorder rows of blocks concatenated in block order to scenario order"""
+    scenario = pd.Categorical(df.index.get_level_values('scenario'),
+                              categories=list(scenarios.keys()))
+    return df.iloc[np.argsort(scenario.codes, kind='stable')]
+
+
+def read_coefficient_scenarios(model_settings, spec, segments):
+    """Specs with the coefficients of each coefficient scenario
+
+    coefficient_scenarios is either the name of a csv file in the
+    configs directory, with 'scenario' and 'target' columns and a
+    column for each segment, e.g.
+
+        scenario,target,hbwl,hbwm,hbwh
+        low_cost,dest_park_cost,-0.1,-0.1,-0.1
+        low_cost,impedance,-0.15,,
+
+    or a dict of scenario: target: segment: coefficient. Coefficients
+    that are not given, such as the blank cells above, keep their value
+    in the spec.
+
+    Parameters
+    ----------
+    model_settings : dict
+    spec : pandas DataFrame, assignment expressions
+    segments : dict, origin zone trip segments
+
+    Returns
+    -------
+    OrderedDict of scenario name: spec, or None if there are no scenarios
+    """
+    scenarios_setting = model_settings.get(SCENARIOS_KEY)
+    if not scenarios_setting:
+        return None
+
+    if isinstance(scenarios_setting, str):
+        file_path = config.config_file_path(scenarios_setting, mandatory=True)
+        logger.info('reading coefficient scenarios \'%s\'' % scenarios_setting)
+        scenarios_df = pd.read_csv(file_path, comment='#', dtype=str)
+        for column in ['scenario', 'target']:
+            if column not in scenarios_df.columns:
+                raise RuntimeError("%s requires a '%s' column" % (scenarios_setting, column))
+
+        coefficients = [(row['scenario'], row['target'], segment, row[segment])
+                        for _, row in scenarios_df.iterrows()
+                        for segment in scenarios_df.columns
+                        if segment not in ['scenario', 'target'] and pd.notna(row[segment])]
+    else:
+        coefficients = [(scenario, target, segment, value)
+                        for scenario, targets in scenarios_setting.items()
+                        for target, values in targets.items()
+                        for segment, value in values.items()]
+
+    scenarios = OrderedDict()
+    for scenario, target, segment, value in coefficients:
+        if target not in spec.target.values:
+            raise RuntimeError("coefficient scenario %s target '%s' is not in the spec"
+                               % (scenario, target))
+        if segment not in segments:
+            raise RuntimeError("coefficient scenario %s segment '%s' is not one of %s"
+                               % (scenario, segment, list(segments.keys())))
+
+        scenario_spec = scenarios.setdefault(str(scenario), spec.copy())
+        scenario_spec[segment] = scenario_spec[segment].astype(object)
+        scenario_spec.loc[scenario_spec.target == target, segment] = value
+
+    logger.info('found %s coefficient scenarios' % len(scenarios))
+
+    return scenarios
+
+
+def utility_dtype(model_settings):
+    """float type for utility and logit calculations, float64 by default"""
+    dtype = np.dtype(model_settings.get(UTILITY_DTYPE_KEY, 'float64'))
+    if dtype not in [np.float32, np.float64]:
+        raise RuntimeError("%s must be float32 or float64" % UTILITY_DTYPE_KEY)
+
+    return dtype
+
+
+def get_chunk_size(model_settings, num_zones, spec, segments, num_processes=1):
+    """Number of origin zones to evaluate at once
+
+    Uses chunk_size if given, otherwise derives it from max_memory_mb
+    using a rough estimate of the float64 arrays held for each OD pair
+    while a block is evaluated: every target, and for each segment its
+    utilities, probabilities and trips. Assembled outputs are not
+    included in the budget, which applies to each process. If neither
+    is given, zones are split evenly between processes.
+
+    Parameters
+    ----------
+    model_settings : dict
+    num_zones : int
+    spec : pandas DataFrame, assignment expressions
+    segments : dict, origin zone trip segments
+    num_processes : int
+
+    Returns
+    -------
+    int
+    """
+    chunk_size = model_settings.get(CHUNK_SIZE_KEY)
+    max_memory_mb = model_settings.get(MAX_MEMORY_KEY)
+
+    if chunk_size and max_memory_mb:
+        raise RuntimeError("specify only one of %s and %s" % (CHUNK_SIZE_KEY, MAX_MEMORY_KEY))
+
+    if max_memory_mb:
+        bytes_per_pair = 8 * (2 * len(spec.index) + 3 * len(segments))
+        chunk_size = int(max_memory_mb * 2**20 // (bytes_per_pair * num_zones))
+        chunk_size = max(chunk_size, 1)
+
+    if not chunk_size and num_processes > 1:
+        chunk_size = -(-num_zones // num_processes)
+
+    if not chunk_size or chunk_size >= num_zones:
+        return num_zones
+
+    logger.info('evaluating %s origin zones per chunk' % chunk_size)
+
+    return int(chunk_size)
+
+
+def origin_blocks(num_zones, chunk_size):
+    """Split origin zone positions into contiguous blocks
+
+    Returns
+    -------
+    list of slices
+    """
+    return [slice(start, min(start + chunk_size, num_zones))
+            for start in range(0, num_zones, chunk_size)]
+
+
 def create_locals_dict(model_settings):
     """Initial local parameters for the destination choice step.
     These will be expanded later and used in subsequent evaluations.
@@ -104,9 +858,10 @@ def create_locals_dict(model_settings):
     return locals_dict
 
 
-def create_od_index(zones_df):
-    orig = np.repeat(np.asanyarray(zones_df.index), zones_df.shape[0])
-    dest = np.tile(np.asanyarray(zones_df.index), zones_df.shape[0])
+def create_od_index(zones_df, orig_rows=slice(None)):
+    orig_index = zones_df.index[orig_rows]
+    orig = np.repeat(np.asanyarray(orig_index), zones_df.shape[0])
+    dest = np.tile(np.asanyarray(zones_df.index), len(orig_index))
     od_df = pd.DataFrame({'orig': orig, 'dest': dest})
 
     return pd.MultiIndex.from_frame(od_df)
@@ -141,7 +896,12 @@ def read_spec_file(model_settings, segments):
 
 
 def create_zone_matrices(zones, od_index, model_settings):
-    """Convert zone values to flattened arrays
+    """Zone attribute accessors for the rows of a long-format OD table
+
+    orig_zone['col'] and dest_zone['col'] return the flattened zone
+    attribute of each OD pair, gathered from the zone column with the
+    od_index level codes when an expression asks for it. Columns are
+    not copied to every OD pair up front, and unused ones never are.
 
     Parameters
     ----------
@@ -151,25 +911,107 @@ def create_zone_matrices(zones, od_index, model_settings):
 
     Returns
     -------
-    dictionary of flattened dest/orig zones
+    dictionary of dest/orig zone accessors
     """
 
     logger.info('creating zone matrices ...')
 
-    dest_zones = zones[model_settings.get('dest_zone', [])]
-    dest_zones.index.name = od_index.names[1]
+    def zone_values(columns, level):
+        level_zones = zones[columns].reindex(od_index.levels[level])
+        return sparse.ZoneValues(level_zones, od_index.codes[level])
+
+    return {
+        'dest_zone': zone_values(model_settings.get('dest_zone', []), 1),
+        'orig_zone': zone_values(model_settings.get('orig_zone', []), 0),
+    }
+
 
-    orig_zones = zones[model_settings.get('orig_zone', [])]
-    orig_zones.index.name = od_index.names[0]
+def create_zone_vectors(zones, model_settings, orig_rows=slice(None)):
+    """Dense equivalent of create_zone_matrices
+
+    Parameters
+    ----------
+    zones : pandas DataFrame
+    model_settings : dict
+    orig_rows : slice
+        origin zone positions
+
+    Returns
+    -------
+    dictionary of broadcastable dest/orig zone vectors
+    """
+    orig_zones = zones.iloc[orig_rows]
 
     return {
-        'dest_zone': dest_zones.join(od_index.to_frame(), how='right'),
-        'orig_zone': orig_zones.join(od_index.to_frame(), how='right')
+        'dest_zone': dense.ZoneVectors(zones[model_settings.get('dest_zone', [])], axis=1),
+        'orig_zone': dense.ZoneVectors(orig_zones[model_settings.get('orig_zone', [])], axis=0),
     }
 
 
+def create_zone_values(zones, model_settings, pairs, orig_rows=slice(None)):
+    """Equivalent of create_zone_vectors for the pairs of a choice set
+
+    Parameters
+    ----------
+    zones : pandas DataFrame
+    model_settings : dict
+    pairs : sparse.ODPairs
+    orig_rows : slice
+        origin zone positions
+
+    Returns
+    -------
+    dictionary of dest/orig zone values for each pair
+    """
+    orig_zones = zones.iloc[orig_rows]
+
+    return {
+        'dest_zone': sparse.ZoneValues(zones[model_settings.get('dest_zone', [])],
+                                       pairs.dest_pos),
+        'orig_zone': sparse.ZoneValues(orig_zones[model_settings.get('orig_zone', [])],
+                                       pairs.orig_pos),
+    }
+
+
+def create_od_arrays(orig_index, dest_index, spec, locals_dict, trace_pairs=None, plan=None):
+    """Dense equivalent of create_od_table. Evaluates expressions on
+    orig x dest arrays
+
+    Parameters
+    ----------
+    orig_index : pandas Index
+    dest_index : pandas Index
+    spec : pandas DataFrame, assignment expressions
+    locals_dict : dict,
+        dictionary containing constants, skims and zone vectors
+    trace_pairs : tuple of (orig positions, dest positions) or None
+    plan : expressions.SpecPlan, optional
+        compiled spec
+
+    Returns
+    -------
+    od_arrays : OrderedDict
+        target name: orig x dest array
+    trace_df : pandas DataFrame or None
+        expression results for trace_pairs
+    """
+
+    logger.info('creating dense OD arrays ...')
+
+    shape = (len(orig_index), len(dest_index))
+    od_arrays, trace_results = dense.evaluate_expressions(spec, locals_dict, shape,
+                                                          trace_pairs=trace_pairs,
+                                                          plan=plan)
+
+    trace_df = None
+    if trace_results is not None:
+        trace_df = trace.trace_frame(trace_pairs, orig_index, dest_index, trace_results)
+
+    return od_arrays, trace_df
+
+
 def create_od_table(od_index, spec, locals_dict, trace_od):
-    """Assign variables with ActivitySim's assign and register output to pipeline
+    """Assign variables with ActivitySim's assign
 
     Parameters
     ----------
@@ -177,48 +1019,88 @@ def create_od_table(od_index, spec, locals_dict, trace_od):
     spec : pandas DataFrame, assignment expressions
     locals_dict : dict,
         dictionary containing constants and zone matrices
-    trace_od : list or dict, origin-destination pair
+    trace_od : list or dict, origin-destination pairs to trace
 
     Returns
     -------
     od_table : pandas DataFrame
         all origin-destination pairs
+    trace_results : pandas DataFrame or None
+        expression results for trace_od rows
     """
 
     logger.info('creating OD table ...')
 
     od_df = od_index.to_frame(index=False)
-    trace_rows = trace.trace_filter(od_df, trace_od)
+
+    trace_rows = None
+    trace_locs = trace.trace_locs(od_index, trace_od)
+    if trace_locs is not None:
+        trace_rows = np.zeros(len(od_index), dtype=bool)
+        trace_rows[trace_locs] = True
+
     od_table, trace_results, _ = assign.assign_variables(spec, od_df,
                                                          locals_dict=locals_dict,
                                                          trace_rows=trace_rows)
 
-    if trace_results is not None:
-        tracing.write_csv(trace_results, file_name='od_table', transpose=False)
-
     od_table.set_index(od_index, inplace=True)
 
-    logger.info('registering OD table to pipeline ...')
-    pipeline.replace_table('od_table', od_table)
-    create_zone_summary(od_table.reset_index())
+    return od_table, trace_results
+
+
+def od_table_arrays(od_table, orig_index, dest_index):
+    """Views of the od_table columns as orig x dest arrays
+
+    Parameters
+    ----------
+    od_table : pandas DataFrame
+        indexed by every orig, dest pair in orig-major order
+    orig_index : pandas Index
+    dest_index : pandas Index
+
+    Returns
+    -------
+    OrderedDict of column name: orig x dest array
+    """
+    shape = (len(orig_index), len(dest_index))
 
-    return od_table
+    return OrderedDict((name, od_table[name].to_numpy().reshape(shape))
+                       for name in od_table.columns)
 
 
-def create_zone_summary(od_table):
+def create_zone_summary(od_table, orig_index, dest_index):
     """Creates summary of od_table summed by origin zone
 
     Parameters
     ----------
     od_table : pandas DataFrame
-        results of expression assignment
+        results of expression assignment, indexed by every orig, dest
+        pair in orig-major order
+    orig_index : pandas Index
+    dest_index : pandas Index
 
     Returns
     -------
-    None
-        registers summary to pipeline
+    pandas DataFrame
     """
     logger.info('creating zone summary table ...')
-    zone_summary = od_table.groupby(['orig']).sum()
-    del zone_summary['dest']
-    pipeline.replace_table('zone_summary', zone_summary)
+    return dense.sum_by_orig(od_table_arrays(od_table, orig_index, dest_index), orig_index)
+
+
+def create_dest_summary(od_table, orig_index, dest_index):
+    """Creates summary of od_table summed by destination zone
+
+    Parameters
+    ----------
+    od_table : pandas DataFrame
+        results of expression assignment, indexed by every orig, dest
+        pair in orig-major order
+    orig_index : pandas Index
+    dest_index : pandas Index
+
+    Returns
+    -------
+    pandas DataFrame
+    """
+    logger.info('creating destination summary table ...')
+    return dense.sum_by_dest(od_table_arrays(od_table, orig_index, dest_index), dest_index)
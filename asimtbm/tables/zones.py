@@ -1,14 +1,25 @@
+import hashlib
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
 
 from activitysim.core import inject, config, tracing
 
+from asimtbm.utils import cache
+from asimtbm.utils import zone_registry
+
 logger = logging.getLogger(__name__)
 
 ZONE_LABEL = 'zone'
 TABLES_YAML = 'tables.yaml'
 TABLE_FILENAMES_KEY = 'aggregate_zone_file_names'
+ALL_COLUMNS_KEY = 'read_all_columns'
+CACHE_KEY = 'cache_zones'
+CACHE_DIR = 'zones'
+CACHE_VERSION = 1
+READ_THREADS_KEY = 'read_threads'
 
 
 @inject.table()
@@ -20,21 +31,77 @@ def zones():
     Each zone file must be the same length and given a 'zone'
     index label. If no 'zone' column is found, row numbers will
     be used for the zone index.
+
+    Only the columns used by the models in settings.yaml are read,
+    unless tables.yaml sets read_all_columns: True. Files are read in
+    parallel threads, at most read_threads at once.
+
+    With cache_zones: True, the combined table is cached between runs
+    and only read from the zone files again when they or the columns
+    used change.
     """
     table_settings = config.read_model_settings(TABLES_YAML)
-    zone_tables = read_zone_tables(table_settings)
-    zones_df = combine_zone_tables(zone_tables)
+
+    columns = None
+    if not table_settings.get(ALL_COLUMNS_KEY, False):
+        columns = zone_registry.referenced_zone_columns(config.setting('models') or [])
+
+    cache_path = None
+    if table_settings.get(CACHE_KEY, False):
+        cache_path = zones_cache_path(table_settings, columns)
+
+    zones_df = cache.load_or_evaluate(
+        cache_path, lambda: combine_zone_tables(read_zone_tables(table_settings, columns)))
+
+    if columns is not None:
+        missing = sorted(columns - set(zones_df.columns))
+        if missing:
+            raise RuntimeError("zone columns %s not found in %s"
+                               % (missing, table_settings.get(TABLE_FILENAMES_KEY)))
 
     inject.add_table('zones', zones_df)
 
     return zones_df
 
 
-def read_zone_tables(table_settings):
+def zones_cache_path(table_settings, columns=None):
+    """Cache file for the zones table
+
+    Keyed by the contents of the zone files, which are only hashed again
+    when their size or modification time changes, and the columns read.
+
+    Parameters
+    ----------
+    table_settings : dict
+    columns : set of str, optional
+
+    Returns
+    -------
+    str, file path
+    """
+    h = hashlib.sha256(('%s\0%s\0' % (CACHE_VERSION, pd.__version__)).encode('utf-8'))
+    for file_name in table_settings.get(TABLE_FILENAMES_KEY):
+        fpath = config.data_file_path(file_name, mandatory=True)
+        h.update(('%s\0%s\0' % (file_name, cache.cached_file_digest(fpath))).encode('utf-8'))
+    h.update(repr(sorted(columns) if columns is not None else None).encode('utf-8'))
+
+    return os.path.join(cache.cache_dir(CACHE_DIR), '%s.pkl' % h.hexdigest())
+
+
+def read_zone_tables(table_settings, columns=None):
     logger.info('reading tables from configs...')
 
     table_filenames = table_settings.get(TABLE_FILENAMES_KEY)
-    tables = [read_zone_indexed_csv_file(f) for f in table_filenames]
+
+    # the csv parser releases the GIL, so files are read in parallel threads
+    num_threads = table_settings.get(READ_THREADS_KEY, min(len(table_filenames),
+                                                           os.cpu_count() or 1))
+    if num_threads > 1 and len(table_filenames) > 1:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            tables = list(executor.map(lambda f: read_zone_indexed_csv_file(f, columns),
+                                       table_filenames))
+    else:
+        tables = [read_zone_indexed_csv_file(f, columns) for f in table_filenames]
 
     logger.info('finished reading tables.')
 
@@ -59,11 +126,35 @@ def combine_zone_tables(zone_tables):
     return combined_zones_df
 
 
-def read_zone_indexed_csv_file(file_name):
-    logger.info('reading file \'%s\'' % file_name)
+def read_zone_indexed_csv_file(file_name, columns=None):
+    """Read a zone csv file
 
+    Parameters
+    ----------
+    file_name : str
+    columns : set of str, optional
+        only read these columns (and the zone id). Files with none of
+        them are still read for their zones, so that combine_zone_tables
+        can check them against the other files.
+
+    Returns
+    -------
+    pandas DataFrame indexed by zone
+    """
     fpath = config.data_file_path(file_name, mandatory=True)
-    zone_df = pd.read_csv(fpath, header=0, comment='#')
+
+    usecols = None
+    if columns is not None:
+        header = pd.read_csv(fpath, header=0, comment='#', nrows=0).columns
+        usecols = [c for c in header if c in columns or c == ZONE_LABEL]
+        if not set(usecols) - {ZONE_LABEL}:
+            logger.info('file \'%s\' has no columns used by the models, reading its zones only'
+                        % file_name)
+            # without a zone column, a column is read to count the zones
+            usecols = [ZONE_LABEL] if ZONE_LABEL in header else list(header[:1])
+
+    logger.info('reading file \'%s\'' % file_name)
+    zone_df = pd.read_csv(fpath, header=0, comment='#', usecols=usecols)
 
     if ZONE_LABEL in zone_df.columns:
         zone_index = ZONE_LABEL  # str
@@ -74,4 +165,7 @@ def read_zone_indexed_csv_file(file_name):
     zone_df.set_index(zone_index, drop=True, inplace=True)
     zone_df.index.name = ZONE_LABEL
 
+    if columns is not None:
+        zone_df = zone_df[[c for c in zone_df.columns if c in columns]]
+
     return zone_df
@@ -0,0 +1,157 @@
+import numpy as np
+import pandas as pd
+
+from activitysim.core import assign
+
+from asimtbm.steps import destination_choice
+from asimtbm.utils import dense
+from asimtbm.utils import sparse
+from asimtbm.utils import trips
+
+
+def zones_df():
+    return pd.DataFrame({
+        'totemp': [10., 0., 20., 5.],
+        'ltpkg': [1., 2., 0., 4.],
+        'trips': [100., 50., 0., 25.],
+    }, index=pd.Index([1, 2, 5, 7], name='zone'))
+
+
+def spec_df():
+    return pd.DataFrame({
+        'description': ['distance', 'parking cost', 'size', 'not available'],
+        'target': ['impedance', 'dest_park_cost', 'size', 'no_size'],
+        'expression': ["skims['dist']",
+                       "dest_zone['ltpkg'] + orig_zone['totemp'] / 10",
+                       "log(dest_zone['totemp'] + 1)",
+                       "size==0"],
+        'seg': ['-0.2', '-0.25', '1', 'NOT_AVAIL'],
+    })
+
+
+def test_dense_matches_long():
+
+    zones = zones_df()
+    spec = spec_df()
+    settings = {'dest_zone': ['ltpkg', 'totemp'], 'orig_zone': ['totemp']}
+    dist = np.arange(16, dtype=np.float64).reshape(4, 4)
+
+    od_index = destination_choice.create_od_index(zones)
+
+    long_locals = {'NOT_AVAIL': -999, 'log': np.log, 'skims': {'dist': dist.ravel()}}
+    long_locals.update(destination_choice.create_zone_matrices(zones, od_index, settings))
+    od_df = od_index.to_frame(index=False)
+    od_table, _, _ = assign.assign_variables(spec, od_df, locals_dict=long_locals)
+    od_table.set_index(od_index, inplace=True)
+
+    dense_locals = {'NOT_AVAIL': -999, 'log': np.log, 'skims': {'dist': dist}}
+    dense_locals.update(destination_choice.create_zone_vectors(zones, settings))
+    od_arrays, _ = dense.evaluate_expressions(spec, dense_locals, dist.shape)
+
+    dense_table = dense.to_long(od_arrays, od_index)
+    for target in od_table.columns:
+        assert np.allclose(dense_table[target].astype(float), od_table[target].astype(float))
+
+    zone_summary = destination_choice.create_zone_summary(od_table, zones.index, zones.index)
+    dest_summary = destination_choice.create_dest_summary(od_table, zones.index, zones.index)
+    assert np.allclose(zone_summary, od_table.groupby(level='orig').sum().astype(float))
+    assert np.allclose(dest_summary, od_table.groupby(level='dest').sum().astype(float))
+    assert np.allclose(dense.sum_by_dest(od_arrays, zones.index), dest_summary)
+
+    segment_od = trips.apply_segment_coeffs(od_table, spec, long_locals, 'seg')
+    long_trips = trips.logit(segment_od, zones['trips'])
+
+    trips_df, _, _ = trips.calculate_num_trips(od_table, zones, spec, long_locals, {'seg': 'trips'})
+    assert np.allclose(trips_df['seg'].values, long_trips.values)
+
+    coeffs = trips.segment_coeff_matrix(spec, dense_locals, {'seg': 'trips'}, list(od_arrays))
+    utils = trips.dense_utilities(od_arrays, coeffs)
+    dense_trips, _, _ = trips.dense_logit(utils, zones[['trips']].values.T)
+
+    assert np.allclose(dense_trips[0].ravel(), long_trips.values)
+
+
+def test_zone_matrices_match_vectors():
+
+    # zones need not be in id order
+    zones = zones_df().iloc[[2, 0, 3, 1]]
+    settings = {'dest_zone': ['ltpkg', 'totemp'], 'orig_zone': ['totemp', 'trips']}
+
+    # all origins, and a block of them as evaluated by a chunk
+    for orig_rows in [slice(None), slice(1, 3)]:
+        od_index = destination_choice.create_od_index(zones, orig_rows=orig_rows)
+        zone_matrices = destination_choice.create_zone_matrices(zones, od_index, settings)
+        zone_vectors = destination_choice.create_zone_vectors(zones, settings, orig_rows)
+        shape = (len(zones.index[orig_rows]), len(zones.index))
+
+        for name, level in [('orig_zone', 'orig'), ('dest_zone', 'dest')]:
+            for col in settings[name]:
+                values = zone_matrices[name][col]
+                assert np.array_equal(values, np.broadcast_to(zone_vectors[name][col],
+                                                              shape).ravel())
+                assert np.array_equal(values,
+                                      zones.loc[od_index.get_level_values(level), col].values)
+
+
+def test_dense_logit_stable():
+
+    utils = np.array([[1000., 999., -np.inf],
+                      [-1000., -1001., -np.inf],
+                      [-np.inf, -np.inf, -np.inf]])
+    orig_trips = np.array([10., 10., 10.])
+
+    num_trips, logsums, _ = trips.dense_logit(utils.copy(), orig_trips)
+
+    expected = np.exp([0., -1., -np.inf]) / np.exp([0., -1.]).sum() * 10
+    assert np.allclose(num_trips[0], expected)
+    assert np.allclose(num_trips[1], expected)
+    assert np.array_equal(num_trips[2], [0., 0., 0.])
+    assert np.allclose(logsums[:2], [1000., -1000.] + np.log(np.exp([0., -1.]).sum()))
+    assert logsums[2] == -np.inf
+
+    num_trips32, _, _ = trips.dense_logit(utils.astype(np.float32), orig_trips)
+    assert num_trips32.dtype == np.float32
+    assert np.allclose(num_trips32, num_trips)
+
+
+def test_sparse_logit_matches_dense():
+
+    utils = np.array([[1., 2., -np.inf],
+                      [-np.inf, -np.inf, -np.inf],
+                      [0.5, -1., 3.]])
+    orig_trips = np.array([10., 10., 20.])
+
+    pairs = sparse.ODPairs.from_mask(np.isfinite(utils))
+    assert pairs.nnz == 5
+    assert np.array_equal(pairs.lookup([0, 1, 2], [1, 1, 2]), [1, 4])
+
+    dense_trips, dense_logsums, _ = trips.dense_logit(utils.copy(), orig_trips)
+    sparse_trips, sparse_logsums, trace = trips.sparse_logit(utils[np.isfinite(utils)],
+                                                             orig_trips, pairs,
+                                                             trace_pairs=(np.array([2]), ))
+
+    assert np.allclose(sparse_trips, dense_trips[np.isfinite(utils)])
+    assert np.array_equal(sparse_logsums, dense_logsums)
+    assert np.allclose(trace['probs'], dense_trips[2, 0] / 20)
+
+
+def test_sample_destinations():
+
+    zones = zones_df()
+    locals_dict = destination_choice.create_zone_vectors(zones, {'dest_zone': ['totemp']})
+    settings = {'size': 1000, 'proposal': "dest_zone['totemp']", 'seed': 2}
+
+    pairs, correction = sparse.sample_destinations(locals_dict, settings, zones.index, (4, 4))
+
+    # zone 2 has no employment so is never sampled
+    assert np.array_equal(pairs.counts, [3, 3, 3, 3])
+    assert not (pairs.dest_pos == 1).any()
+    assert np.abs(correction).max() < 0.2
+
+    # samples are seeded by origin zone, so do not depend on blocks
+    block_locals = destination_choice.create_zone_vectors(zones, {'dest_zone': ['totemp']},
+                                                          orig_rows=slice(2, 4))
+    block_pairs, block_correction = sparse.sample_destinations(block_locals, settings,
+                                                               zones.index[2:], (2, 4))
+    assert np.array_equal(block_pairs.dest_pos, pairs.dest_pos[pairs.indptr[2]:])
+    assert np.array_equal(block_correction, correction[pairs.indptr[2]:])
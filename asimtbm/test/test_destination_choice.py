@@ -0,0 +1,267 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from activitysim.core import config
+from activitysim.core import inject
+from activitysim.core import pipeline
+
+from asimtbm.steps import destination_choice
+from asimtbm.utils import skim_files
+from asimtbm.utils import skims
+from .utils import example_dir, setup_working_dir
+
+OUTPUT_TABLES = ['od_table', 'trips', 'zone_summary', 'dest_summary', 'logsums']
+
+read_model_settings = config.read_model_settings
+read_spec_file = destination_choice.read_spec_file
+
+
+def teardown_function(func):
+    inject.clear_cache()
+    inject.reinject_decorated_tables()
+
+
+def run_destination_choice(monkeypatch, injectables=None, output_tables=OUTPUT_TABLES,
+                           **settings):
+    """Run the example's destination choice step with settings added to
+    destination_choice.yaml
+
+    injectables, e.g. data_dir, replace the example's.
+
+    Returns
+    -------
+    dict of pipeline table name: DataFrame
+    """
+    setup_working_dir('example')
+
+    # importing asimtbm also registers injectibles
+    import asimtbm  # noqa: F401
+
+    for name, value in (injectables or {}).items():
+        inject.add_injectable(name, value)
+
+    def read_settings(file_name, *args, **kwargs):
+        model_settings = read_model_settings(file_name, *args, **kwargs)
+        if file_name == destination_choice.YAML_FILENAME:
+            model_settings = dict(model_settings, **settings)
+        return model_settings
+
+    monkeypatch.setattr(config, 'read_model_settings', read_settings)
+
+    try:
+        pipeline.run(['destination_choice'])
+        tables = {name: pipeline.get_table(name) for name in output_tables}
+    finally:
+        pipeline.close_pipeline()
+
+    inject.clear_cache()
+    inject.reinject_decorated_tables()
+
+    return tables
+
+
+def assert_tables_equal(tables, expected):
+    for name, df in expected.items():
+        assert tables[name].index.equals(df.index)
+        assert list(tables[name].columns) == list(df.columns)
+        assert np.allclose(tables[name].values.astype(float), df.values.astype(float))
+
+
+def test_dense_engine(monkeypatch):
+
+    long_tables = run_destination_choice(monkeypatch, engine='long')
+    dense_tables = run_destination_choice(monkeypatch, engine='dense')
+
+    assert_tables_equal(dense_tables, long_tables)
+
+
+@pytest.mark.parametrize('engine', ['long', 'dense'])
+def test_chunked(monkeypatch, engine):
+
+    tables = run_destination_choice(monkeypatch, engine=engine)
+
+    assert_tables_equal(run_destination_choice(monkeypatch, engine=engine, chunk_size=7), tables)
+
+    # about 3 of the 25 example zones per chunk
+    assert_tables_equal(run_destination_choice(monkeypatch, engine=engine, max_memory_mb=0.01),
+                        tables)
+
+
+@pytest.mark.parametrize('engine', ['long', 'dense'])
+def test_num_processes(monkeypatch, engine):
+
+    tables = run_destination_choice(monkeypatch, engine=engine)
+
+    # blocks are evaluated in worker processes and merged in origin zone order
+    assert_tables_equal(run_destination_choice(monkeypatch, engine=engine, num_processes=2,
+                                               chunk_size=4),
+                        tables)
+
+    # without fork, blocks are evaluated serially
+    monkeypatch.setattr(destination_choice.multiprocessing, 'get_all_start_methods',
+                        lambda: ['spawn'])
+    monkeypatch.setattr(destination_choice.multiprocessing, 'get_context', None)
+    assert_tables_equal(run_destination_choice(monkeypatch, engine=engine, num_processes=2),
+                        tables)
+
+
+@pytest.mark.parametrize('engine', ['long', 'dense'])
+def test_num_processes_skim_memory(monkeypatch, engine):
+
+    # two skims, of which only one fits in the skim memory budget
+    set_spec(monkeypatch, expression={0: "skims['mf3'] + 0 * skims['mf4']"})
+    tables = run_destination_choice(monkeypatch, engine=engine)
+
+    parent = os.getpid()
+    read_from_omx = skims.Skims.read_from_omx
+
+    def read_in_parent(self, key):
+        # workers must not read from the omx file handle they inherit
+        assert os.getpid() == parent
+        return read_from_omx(self, key)
+
+    monkeypatch.setattr(skims.Skims, 'read_from_omx', read_in_parent)
+
+    assert_tables_equal(run_destination_choice(monkeypatch, engine=engine, num_processes=2,
+                                               chunk_size=4, max_skim_memory_mb=0.005),
+                        tables)
+
+
+def copy_example_data(tmp_path):
+    """Copy of the example data and an empty output directory, as injectables"""
+    data_dir = str(tmp_path / 'data')
+    shutil.copytree(os.path.join(example_dir('example'), 'data'), data_dir)
+    output_dir = tmp_path / 'output'
+    output_dir.mkdir()
+
+    return {'data_dir': data_dir, 'output_dir': str(output_dir)}
+
+
+def set_spec(monkeypatch, **changes):
+    """Change spec cells, given as {column: {row: value}}"""
+
+    def read_changed_spec(model_settings, segments):
+        spec = read_spec_file(model_settings, segments)
+        for column, values in changes.items():
+            for row, value in values.items():
+                spec.loc[row, column] = value
+        return spec
+
+    monkeypatch.setattr(destination_choice, 'read_spec_file', read_changed_spec)
+
+
+@pytest.mark.parametrize('engine', ['long', 'dense'])
+def test_od_table_cache(monkeypatch, tmp_path, engine):
+
+    injectables = copy_example_data(tmp_path)
+
+    skim_reads = []
+    read_from_omx = skims.Skims.read_from_omx
+
+    def count_read_from_omx(self, key):
+        skim_reads.append(key)
+        return read_from_omx(self, key)
+
+    monkeypatch.setattr(skims.Skims, 'read_from_omx', count_read_from_omx)
+
+    def run(**settings):
+        del skim_reads[:]
+        settings = dict({'engine': engine, 'cache_od_table': True}, **settings)
+        return run_destination_choice(monkeypatch, injectables=injectables, **settings)
+
+    tables = run()
+    assert skim_reads
+
+    # coefficient changes reuse the cached expressions
+    set_spec(monkeypatch, hbwl={0: '-0.3'})
+    coefficient_tables = run()
+    assert not skim_reads
+    assert_tables_equal({'od_table': coefficient_tables['od_table']},
+                        {'od_table': tables['od_table']})
+    assert not np.allclose(coefficient_tables['trips']['hbwl'], tables['trips']['hbwl'])
+    assert_tables_equal(coefficient_tables, run(cache_od_table=False))
+
+    # expression changes do not
+    set_spec(monkeypatch, expression={0: "skims['mf3'] * 2"})
+    expression_tables = run()
+    assert skim_reads
+    assert np.allclose(expression_tables['od_table']['impedance'],
+                       2 * tables['od_table']['impedance'])
+
+    # nor do skim type changes
+    set_spec(monkeypatch)
+    run(skim_dtypes={'mf3': 'float32'})
+    assert skim_reads
+    run(skim_dtypes={'mf3': 'float32', 'mf4': 'float32'})
+    assert not skim_reads
+
+    # nor do zone data changes
+    totemp_path = os.path.join(injectables['data_dir'], 'ma.totemp.csv')
+    totemp = pd.read_csv(totemp_path)
+    totemp['totemp'] *= 2
+    totemp.to_csv(totemp_path, index=False)
+    zone_tables = run()
+    assert skim_reads
+    assert np.allclose(zone_tables['od_table']['size'],
+                       tables['od_table']['size'] + np.log(2))
+
+
+@pytest.mark.parametrize('engine', ['long', 'dense'])
+def test_npy_skims(monkeypatch, tmp_path, engine):
+
+    tables = run_destination_choice(monkeypatch, engine=engine)
+
+    injectables = copy_example_data(tmp_path)
+    skim_files.convert_omx(os.path.join(injectables['data_dir'], 'skims.omx'),
+                           os.path.join(injectables['data_dir'], 'skims_npy'), chunk_rows=4)
+
+    row_reads = []
+    read_rows = skims.Skims.read_rows
+
+    def count_read_rows(self, key, rows):
+        row_reads.append(rows)
+        return read_rows(self, key, rows)
+
+    monkeypatch.setattr(skims.Skims, 'read_rows', count_read_rows)
+
+    # chunks read their rows of the skims
+    npy_tables = run_destination_choice(monkeypatch, injectables=injectables, engine=engine,
+                                        chunk_size=7, prefetch_skims=False,
+                                        aggregate_od_matrices={'skims': 'skims_npy'})
+    assert_tables_equal(npy_tables, tables)
+    assert len(row_reads) > 1
+
+
+def test_coefficient_scenarios(monkeypatch):
+
+    tables = run_destination_choice(monkeypatch)
+
+    scenarios = {
+        'base': {'impedance': {'hbwl': -0.2}},
+        'far': {'impedance': {'hbwl': -0.1}},
+    }
+    output_tables = OUTPUT_TABLES + destination_choice.SCENARIO_OUTPUTS
+
+    for settings in [{}, {'engine': 'dense', 'chunk_size': 7, 'scenario_threads': 2}]:
+        scenario_tables = run_destination_choice(monkeypatch, output_tables=output_tables,
+                                                 coefficient_scenarios=scenarios, **settings)
+        scenario_trips = scenario_tables['scenario_trips']
+        scenario_logsums = scenario_tables['scenario_logsums']
+
+        assert list(scenario_trips.index.unique(level='scenario')) == ['base', 'far']
+
+        # the base coefficients reproduce the trips and logsums of the step
+        assert_tables_equal({'trips': scenario_trips.loc['base'],
+                             'logsums': scenario_logsums.loc['base']},
+                            {'trips': tables['trips'], 'logsums': tables['logsums']})
+
+        # only the changed segment changes
+        far_trips = scenario_trips.loc['far']
+        far_logsums = scenario_logsums.loc['far']
+        assert not np.allclose(far_trips['hbwl'], tables['trips']['hbwl'])
+        assert not np.allclose(far_logsums['hbwl'], tables['logsums']['hbwl'])
+        assert np.allclose(far_trips[['hbwm', 'hbwh']], tables['trips'][['hbwm', 'hbwh']])
@@ -42,6 +42,8 @@ def test_example():
         'final_od_table.csv',
         'final_trips.csv',
         'final_zone_summary.csv',
+        'final_dest_summary.csv',
+        'final_logsums.csv',
     ]
     trace_output_files = [
         'trace.segment_od_hbwh.csv',
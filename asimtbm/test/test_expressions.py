@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from asimtbm.steps import destination_choice
+from asimtbm.utils import expressions
+
+
+def test_compile_spec():
+
+    spec = pd.DataFrame({
+        'target': ['impedance', 'size', 'attraction', 'no_size'],
+        'expression': ["skims['dist'] * 2",
+                       "log(dest_zone['totemp'])",
+                       "log(dest_zone['totemp']) + skims['dist'] * 2",
+                       "size==0"],
+    })
+
+    plan = expressions.compile_spec(spec)
+
+    assert plan.references == {'skims': ['dist'], 'dest_zone': ['totemp']}
+    assert len(plan.temps) == 2
+
+    locals_dict = {
+        'log': np.log,
+        'skims': {'dist': np.arange(6.).reshape(2, 3)},
+        'dest_zone': {'totemp': np.array([[1., 0., 3.]])},
+    }
+
+    expected = dict(locals_dict)
+    for target, expression in zip(spec.target, spec.expression):
+        expected[target] = eval(expression, {}, expected)
+
+    results = dict(locals_dict)
+    for target, values in plan.run(results):
+        results[target] = values
+        assert np.array_equal(values, expected[target])
+
+    # hoisted temps are released after their last use
+    assert not [name for name in results if name.startswith(expressions.CSE_PREFIX)]
+
+
+def test_spec_references():
+
+    spec = pd.DataFrame({
+        'target': ['impedance', 'size'],
+        'expression': ["skims['dist']", "log(dest_zone['totemp'])"],
+    })
+    model_settings = {
+        'dest_zone': ['totemp'],
+        'choice_set': {'available': "dest_zone['ltpkg'] > 0", 'distance': "skims['time']"},
+    }
+
+    references = destination_choice.spec_references(expressions.compile_spec(spec),
+                                                    model_settings)
+
+    assert references['skims'] == {'dist', 'time'}
+    assert references['dest_zone'] == {'totemp', 'ltpkg'}
+    assert references['log'] == set()
+
+    with pytest.raises(RuntimeError, match="dest_zone\\['ltpkg'\\]"):
+        destination_choice.check_zone_references(references, model_settings)
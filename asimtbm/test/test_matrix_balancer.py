@@ -7,6 +7,7 @@ from activitysim.core import config
 
 from unittest.mock import Mock
 
+from asimtbm.steps.balance_trips import balance_segments
 from asimtbm.utils.matrix_balancer import Balancer
 from .utils import setup_working_dir
 
@@ -81,6 +82,149 @@ def test_balancer_class():
     assert diff.empty
 
 
+def test_balancer_dense():
+
+    # duplicate (orig, dest) rows and a missing pair
+    df = pd.DataFrame({
+        'orig': [1, 1, 1, 2, 2],
+        'dest': [1, 1, 2, 1, 3],
+        'trips': [1., 3., 2., 5., 5.],
+    })
+    orig_targets = pd.Series([12., 8.], index=pd.Index([1, 2], name='orig'))
+    dest_targets = pd.Series([10., 4., 6.], index=pd.Index([1, 2, 3], name='dest'))
+
+    balancer = Balancer(df, [orig_targets, dest_targets], [['orig'], ['dest']],
+                        weight_col='trips', max_iteration=100, closure=1e-12)
+    assert balancer.seed.shape == (2, 3)
+    assert balancer.seed[0, 0] == 4.
+
+    m, converged, info_df = balancer.iteration()
+    assert converged
+    assert list(info_df.columns) == ['conv']
+    assert info_df['conv'].iloc[-1] < 1e-6
+
+    balanced_df = balancer.balance()
+    assert np.allclose(balanced_df.groupby('orig')['trips'].sum(), orig_targets)
+    assert np.allclose(balanced_df.groupby('dest')['trips'].sum(), dest_targets)
+
+    # rows sharing a cell keep their proportions
+    assert np.isclose(balanced_df['trips'][1], 3 * balanced_df['trips'][0])
+    assert m[1, 1] == 0
+
+
+def test_balancer_sparse():
+
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame({
+        'orig': np.repeat(np.arange(1, 9), 8),
+        'dest': np.tile(np.arange(1, 9), 8),
+        'trips': rng.rand(64) * (rng.rand(64) < 0.3),
+    })
+    orig_targets = df.groupby('orig')['trips'].sum() * rng.uniform(0.5, 1.5, 8)
+    dest_targets = df.groupby('dest')['trips'].sum()
+    dest_targets *= orig_targets.sum() / dest_targets.sum()
+
+    balanced = []
+    for sparse in [False, True]:
+        balancer = Balancer(df, [orig_targets, dest_targets], [['orig'], ['dest']],
+                            weight_col='trips', max_iteration=20, sparse=sparse)
+        _, _, info_df = balancer.iteration()
+        balanced.append((balancer.balance(), info_df))
+
+    assert len(balancer.seed) == (df['trips'] != 0).sum()
+    assert np.allclose(balanced[0][0]['trips'], balanced[1][0]['trips'])
+    assert np.allclose(balanced[0][1], balanced[1][1])
+
+
+def test_balancer_anderson():
+
+    rng = np.random.RandomState(1)
+    df = pd.DataFrame({
+        'orig': np.repeat(np.arange(30), 30),
+        'dest': np.tile(np.arange(30), 30),
+        'trips': rng.lognormal(0, 2, 900),
+    })
+    orig_targets = df.groupby('orig')['trips'].sum() * rng.uniform(0.2, 5, 30)
+    dest_targets = df.groupby('dest')['trips'].sum() * rng.uniform(0.2, 5, 30)
+    dest_targets *= orig_targets.sum() / dest_targets.sum()
+
+    results = {}
+    for method in ['ipf', 'anderson']:
+        balancer = Balancer(df, [orig_targets, dest_targets], [['orig'], ['dest']],
+                            weight_col='trips', convergence_rate=1e-8, max_iteration=1000,
+                            closure=1e-12, method=method)
+        results[method] = balancer.iteration()
+
+    m, converged, info_df = results['anderson']
+    assert converged
+    assert len(info_df) < len(results['ipf'][2])
+    assert np.allclose(m, results['ipf'][0], rtol=1e-6)
+
+
+def test_balancer_warm_start():
+
+    rng = np.random.RandomState(2)
+    df = pd.DataFrame({
+        'orig': np.repeat(np.arange(1, 9), 8),
+        'dest': np.tile(np.arange(1, 9), 8),
+        'trips': rng.rand(64) * (rng.rand(64) < 0.7),
+    })
+    orig_targets = df.groupby('orig')['trips'].sum() * rng.uniform(0.5, 1.5, 8)
+    dest_targets = df.groupby('dest')['trips'].sum()
+    dest_targets *= orig_targets.sum() / dest_targets.sum()
+    aggregates = [orig_targets, dest_targets]
+    dimensions = [['orig'], ['dest']]
+
+    for sparse in [False, True]:
+        for method in ['ipf', 'anderson']:
+            settings = {'weight_col': 'trips', 'max_iteration': 200, 'closure': 1e-12,
+                        'sparse': sparse, 'method': method}
+
+            balancer = Balancer(df, aggregates, dimensions, **settings)
+            balanced = balancer.balance()
+            factors = balancer.balancing_factors()
+            assert np.allclose(balanced['trips'], df['trips']
+                               * factors[0].loc[df['orig']].values
+                               * factors[1].loc[df['dest']].values)
+
+            warm = Balancer(df, aggregates, dimensions, initial_factors=factors, **settings)
+            _, _, info_df = warm.iteration()
+            assert len(info_df) <= 2
+            assert np.allclose(warm.balance()['trips'], balanced['trips'])
+
+            # factors for other zones are ignored
+            other = Balancer(df[df['orig'] != 8], aggregates, dimensions,
+                             initial_factors=factors, **settings)
+            assert other.initial_factors is None
+
+
+def test_balance_segments():
+
+    rng = np.random.RandomState(1)
+    df = pd.DataFrame({
+        'orig': np.tile(np.repeat(np.arange(1, 7), 6), 2),
+        'dest': np.tile(np.arange(1, 7), 12),
+        'segment': np.repeat(['work', 'shop'], 36),
+        'trips': rng.rand(72) + 0.1,
+    })
+    orig_targets = df.groupby(['orig', 'segment'])['trips'].sum() * rng.uniform(0.5, 1.5, 12)
+    dest_targets = df.groupby(['dest', 'segment'])['trips'].sum()
+    dest_targets *= (orig_targets.groupby(level='segment').sum()
+                     / dest_targets.groupby(level='segment').sum()).reindex(
+                         dest_targets.index, level='segment')
+
+    aggregates = [orig_targets, dest_targets]
+    dimensions = [['orig', 'segment'], ['dest', 'segment']]
+    settings = {'max_iteration': 100, 'closure': 1e-10}
+
+    joint = Balancer(df, aggregates, dimensions, weight_col='trips', **settings).balance()
+
+    for num_threads in [1, 2]:
+        balanced = balance_segments(df, aggregates, dimensions, num_threads, settings)
+        assert balanced[['orig', 'dest', 'segment']].equals(df[['orig', 'dest', 'segment']])
+        assert np.allclose(balanced['trips'], joint['trips'])
+
+
 def test_balancer_step():
 
     setup_working_dir('example_balance', inherit=True)
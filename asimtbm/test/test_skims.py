@@ -0,0 +1,261 @@
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from activitysim.core import inject
+
+from asimtbm.utils import skim_files
+from asimtbm.utils import skims
+from .utils import setup_working_dir
+
+
+def teardown_function(func):
+    inject.clear_cache()
+    inject.reinject_decorated_tables()
+
+
+class ChunkedArray(object):
+    """numpy array standing in for a chunked omx matrix, recording reads"""
+
+    def __init__(self, data, chunkshape):
+        self.data = data
+        self.dtype = data.dtype
+        self.shape = data.shape
+        self.chunkshape = chunkshape
+        self.reads = []
+
+    def __getitem__(self, key):
+        self.reads.append(key)
+        return self.data[key]
+
+
+def test_read_subset():
+
+    data = np.arange(100 * 100, dtype=np.float32).reshape(100, 100)
+
+    for indices in [np.arange(100), np.arange(10, 30), np.array([97, 3, 50, 4, 3]),
+                    np.array([60, 62, 61]), np.array([], dtype=int)]:
+        node = ChunkedArray(data, (8, 100))
+        subset = skims.read_subset(node, indices)
+        assert np.array_equal(subset, data[np.ix_(indices, indices)])
+        assert subset.flags.c_contiguous
+
+    # contiguous indices are read with one slice
+    node = ChunkedArray(data, (8, 100))
+    skims.read_subset(node, np.arange(10, 30))
+    assert node.reads == [(slice(10, 30), slice(10, 30))]
+
+    # rows of other zones than the columns
+    rows, cols = np.array([97, 3]), np.array([60, 62, 61, 3])
+    node = ChunkedArray(data, (8, 100))
+    assert np.array_equal(skims.read_subset(node, rows, cols), data[np.ix_(rows, cols)])
+    assert [rows for rows, _ in node.reads] == [slice(0, 98)]
+
+
+def test_read_subset_blocks(monkeypatch):
+
+    monkeypatch.setattr(skims, 'READ_BLOCK_BYTES', 8 * 100 * 4)
+
+    data = np.arange(100 * 100, dtype=np.float32).reshape(100, 100)
+    indices = np.array([90, 2, 5, 91])
+
+    node = ChunkedArray(data, (8, 100))
+    subset = skims.read_subset(node, indices)
+    assert np.array_equal(subset, data[np.ix_(indices, indices)])
+
+    # only chunk aligned blocks holding wanted rows are read
+    assert [rows for rows, _ in node.reads] == [slice(0, 8), slice(88, 92)]
+
+
+def test_skim_cache_eviction():
+
+    skim_cache = skims.SkimCache(max_bytes=200)
+    for key in ['a', 'b']:
+        skim_cache[key] = np.zeros(10)
+
+    # 'b' is least recently used once 'a' is read again
+    assert skim_cache['a'] is not None
+    skim_cache['c'] = np.zeros(10)
+    assert list(skim_cache.arrays) == ['a', 'c']
+    assert skim_cache.nbytes == 160
+
+    # the newest skim is kept even if over budget
+    skim_cache['d'] = np.zeros(100)
+    assert list(skim_cache.arrays) == ['d']
+
+    # and so are pinned skims
+    skim_cache.pinned.add('d')
+    skim_cache['e'] = np.zeros(10)
+    skim_cache['f'] = np.zeros(10)
+    assert list(skim_cache.arrays) == ['d', 'f']
+
+    skim_cache.clear(['d'])
+    assert not skim_cache.pinned
+
+
+def test_npy_skims_file(tmpdir):
+
+    data = np.arange(25.).reshape(5, 5)
+    for folder in ['data', 'lookup']:
+        os.makedirs(os.path.join(str(tmpdir), folder))
+    np.save(os.path.join(str(tmpdir), 'data', 'DIST.npy'), data)
+    np.save(os.path.join(str(tmpdir), 'lookup', 'zone_id.npy'), np.array([10, 20, 30, 40, 50]))
+
+    skims_file = skim_files.open_skims_file(str(tmpdir))
+    assert isinstance(skims_file, skim_files.NpySkimsFile)
+    assert skims_file.shape() == (5, 5)
+    assert skims_file.listMatrices() == ['DIST']
+    assert list(skims_file.mapping('zone_id')) == [10, 20, 30, 40, 50]
+
+    indices = np.array([2, 0, 4])
+    assert np.array_equal(skims.read_subset(skims_file['DIST'], indices),
+                          data[np.ix_(indices, indices)])
+
+
+def write_npy_skims(dir_path, matrices, zones):
+    """Write a directory of .npy skims, see skim_files.NpySkimsFile"""
+    for folder in ['data', 'lookup']:
+        os.makedirs(os.path.join(dir_path, folder), exist_ok=True)
+    for name, data in matrices.items():
+        np.save(os.path.join(dir_path, 'data', '%s.npy' % name), data)
+    np.save(os.path.join(dir_path, 'lookup', 'zone_id.npy'), np.array(zones))
+
+
+def test_read_cached(tmpdir, monkeypatch):
+
+    setup_working_dir('example')
+    inject.add_injectable('output_dir', str(tmpdir.mkdir('output')))
+
+    skims_path = str(tmpdir.join('skims'))
+    data = np.arange(25.).reshape(5, 5)
+    write_npy_skims(skims_path, {'DIST': data}, [10, 20, 30, 40, 50])
+
+    reads = []
+    read_from_omx = skims.Skims.read_from_omx
+
+    def count_read_from_omx(self, key):
+        reads.append(key)
+        return read_from_omx(self, key)
+
+    monkeypatch.setattr(skims.Skims, 'read_from_omx', count_read_from_omx)
+
+    def read_cached(zones, dtypes=None):
+        del reads[:]
+        return skims.Skims('skims', skims_path, pd.Index(zones), dense=True, cache=True,
+                           dtypes=dtypes).read_cached('DIST')
+
+    rows = np.array([4, 0, 2])
+    cached = read_cached([50, 10, 30])
+    assert reads == ['DIST']
+    assert np.array_equal(cached, data[np.ix_(rows, rows)])
+    assert isinstance(cached, np.memmap) and not cached.flags.writeable
+
+    # later reads map the cached file
+    assert np.array_equal(read_cached([50, 10, 30]), cached)
+    assert reads == []
+
+    # the cache is keyed by the zones, the type and the file contents
+    assert np.array_equal(read_cached([10, 20]), data[:2, :2])
+    assert reads == ['DIST']
+
+    assert read_cached([50, 10, 30], dtypes={'DIST': np.dtype('float32')}).dtype == np.float32
+    assert reads == ['DIST']
+
+    # a different size, so the change is seen even with coarse modification times
+    write_npy_skims(skims_path, {'DIST': (data + 1).astype(np.float32)}, [10, 20, 30, 40, 50])
+    assert np.array_equal(read_cached([50, 10, 30]), data[np.ix_(rows, rows)] + 1)
+    assert reads == ['DIST']
+
+
+def test_prefetch(tmpdir, monkeypatch):
+
+    skims_path = str(tmpdir.join('skims'))
+    zones = pd.Index([50, 10, 30])
+    matrices = {'DIST': np.arange(25.).reshape(5, 5), 'TIME': np.arange(25.).reshape(5, 5) * 2}
+    write_npy_skims(skims_path, matrices, [10, 20, 30, 40, 50])
+
+    expected = skims.Skims('skims', skims_path, zones, dense=True)
+    prefetched = skims.Skims('skims', skims_path, zones, dense=True)
+    prefetched.prefetch(['DIST', 'TIME'])
+    for key in ['DIST', 'TIME']:
+        assert np.array_equal(prefetched[key], expected[key])
+    prefetched.wait()
+    assert not prefetched._futures
+    expected.close()
+    prefetched.close()
+
+    # close cancels pending reads and waits for the one in progress
+    started = threading.Event()
+    release = threading.Event()
+    reads = []
+    read_from_omx = skims.Skims.read_from_omx
+
+    def slow_read_from_omx(self, key):
+        reads.append(key)
+        started.set()
+        release.wait(10)
+        return read_from_omx(self, key)
+
+    monkeypatch.setattr(skims.Skims, 'read_from_omx', slow_read_from_omx)
+
+    prefetched = skims.Skims('skims', skims_path, zones, dense=True)
+    prefetched.prefetch(['DIST', 'TIME'])
+    assert started.wait(10)
+
+    closer = threading.Thread(target=prefetched.close)
+    closer.start()
+    closer.join(0.2)
+    assert closer.is_alive()
+
+    release.set()
+    closer.join(10)
+    assert not closer.is_alive()
+
+    for thread in threading.enumerate():
+        if thread.name.startswith('skims_'):
+            thread.join(10)
+            assert not thread.is_alive()
+    assert reads == ['DIST']
+
+
+def test_skims_block_reads_rows(tmpdir, monkeypatch):
+
+    skims_path = str(tmpdir.join('skims'))
+    data = np.arange(100.).reshape(10, 10)
+    write_npy_skims(skims_path, {'DIST': data}, list(range(1, 11)))
+
+    # record the rows read from the .npy file, in chunks of 2 rows
+    nodes = []
+    getitem = skim_files.NpySkimsFile.__getitem__
+
+    def chunked_getitem(self, key):
+        nodes.append(ChunkedArray(getitem(self, key), (2, 10)))
+        return nodes[-1]
+
+    monkeypatch.setattr(skim_files.NpySkimsFile, '__getitem__', chunked_getitem)
+    monkeypatch.setattr(skims, 'READ_BLOCK_BYTES', 1)
+
+    def rows_read():
+        return [rows for node in nodes for rows, _ in node.reads]
+
+    zones = pd.Index([7, 8, 1, 2, 3])
+    positions = np.array([6, 7, 0, 1, 2])
+    skims_file = skims.Skims('skims', skims_path, zones, dense=True)
+
+    # a block only reads the chunks holding its rows, once
+    block = skims_file.block(slice(0, 2))
+    assert np.array_equal(block['DIST'], data[np.ix_(positions[:2], positions)])
+    assert np.array_equal(block['DIST'], data[np.ix_(positions[:2], positions)])
+    assert rows_read() == [slice(6, 8)]
+    assert ('skims', 'DIST') not in skims_file.skim_cache
+
+    # blocks slice the whole matrix once it is in memory
+    assert np.array_equal(skims_file['DIST'], data[np.ix_(positions, positions)])
+    del nodes[:]
+    block = skims_file.block(slice(2, 5))
+    assert np.array_equal(block['DIST'], data[np.ix_(positions[2:], positions)])
+    assert rows_read() == []
+
+    skims_file.close()
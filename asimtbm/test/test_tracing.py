@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+
+from asimtbm.utils import tracing
+
+
+def test_parse_trace_od():
+
+    assert tracing.parse_trace_od([3, 32]) == [([3], [32])]
+    assert tracing.parse_trace_od({'o': 3}) == [([3], None)]
+    assert tracing.parse_trace_od([[3, 32], {'o': [5, 7]}, {'d': 12}]) == \
+        [([3], [32]), ([5, 7], None), (None, [12])]
+    assert tracing.parse_trace_od(None) == []
+
+
+def test_trace_lookups_agree():
+
+    zones = pd.Index([1, 2, 5, 7])
+    od_index = pd.MultiIndex.from_product([zones, zones], names=['orig', 'dest'])
+    od_df = od_index.to_frame(index=False)
+
+    for trace_od in [[2, 7], {'o': 5}, {'d': [1, 7]}, [[7, 1], {'o': 2, 'd': [5, 99]}, [2, 5]]]:
+        mask = tracing.trace_filter(od_df, trace_od)
+        locs = tracing.trace_locs(od_index, trace_od)
+        orig_pos, dest_pos = tracing.trace_positions(zones, zones, trace_od)
+
+        assert np.array_equal(locs, np.flatnonzero(mask))
+        assert np.array_equal(locs, orig_pos * len(zones) + dest_pos)
+
+    assert tracing.trace_locs(od_index, [3, 32]) is None
+    assert tracing.trace_positions(zones, zones, [3, 32]) is None
+
+    shuffled = od_index[::-1]
+    assert np.array_equal(shuffled[tracing.trace_locs(shuffled, {'o': 5})].sort_values(),
+                          od_index[tracing.trace_locs(od_index, {'o': 5})])
+
+
+def test_trace_locs_missing_pairs():
+
+    od_index = pd.MultiIndex.from_tuples([(1, 1), (1, 2), (2, 1)], names=['orig', 'dest'])
+
+    for index in [od_index, od_index[::-1]]:
+        assert tracing.trace_locs(index, [2, 2]) is None
+        assert tracing.trace_locs(index, [3, 32]) is None
+        assert tracing.trace_locs(index, {'o': 3}) is None
+
+        locs = tracing.trace_locs(index, [[2, 2], [2, 1], {'o': 1, 'd': [2, 5]}])
+        assert sorted(index[locs]) == [(1, 2), (2, 1)]
+
+    # pair pruned from an index whose levels still have both zones
+    pruned = od_index[od_index != (2, 1)]
+    assert tracing.trace_locs(pruned, [2, 1]) is None
@@ -0,0 +1,149 @@
+import threading
+
+import pandas as pd
+import pytest
+
+from activitysim.core import config
+from activitysim.core import inject
+
+from asimtbm.steps import balance_trips
+from asimtbm.steps import destination_choice
+from asimtbm.tables import zones
+from asimtbm.utils import zone_registry
+from .utils import setup_working_dir
+
+
+def teardown_function(func):
+    inject.clear_cache()
+    inject.reinject_decorated_tables()
+
+
+def setup_zone_files(data_dir, zone_files):
+    """Write zone csv files to data_dir and read data files from there
+
+    Parameters
+    ----------
+    data_dir : pathlib.Path
+    zone_files : dict of file name: DataFrame
+    """
+    setup_working_dir('example')
+
+    for file_name, df in zone_files.items():
+        df.to_csv(str(data_dir / file_name), index=False)
+
+    inject.add_injectable('data_dir', str(data_dir))
+
+
+def test_unused_zone_files_are_checked(tmp_path):
+
+    setup_zone_files(tmp_path, {
+        'emp.csv': pd.DataFrame({'zone': [1, 2, 3], 'totemp': [10., 0., 5.]}),
+        'other.csv': pd.DataFrame({'zone': [1, 2, 4], 'hh': [1, 2, 3]}),
+        'numbered.csv': pd.DataFrame({'hh': [4, 5, 6]}),
+    })
+
+    tables = zones.read_zone_tables(
+        {zones.TABLE_FILENAMES_KEY: ['emp.csv', 'numbered.csv']}, {'totemp'})
+    assert [list(table.columns) for table in tables] == [['totemp'], []]
+
+    zones_df = zones.combine_zone_tables(tables)
+    assert list(zones_df.columns) == ['totemp']
+    assert list(zones_df.index) == [1, 2, 3]
+
+    # files without used columns must still have the same zones
+    tables = zones.read_zone_tables(
+        {zones.TABLE_FILENAMES_KEY: ['emp.csv', 'other.csv']}, {'totemp'})
+    with pytest.raises(RuntimeError):
+        zones.combine_zone_tables(tables)
+
+
+def test_referenced_zone_columns():
+
+    setup_working_dir('example')
+
+    # steps register their zone columns when imported
+    dest_columns, balance_columns = [
+        step.zone_columns(config.read_model_settings(step.YAML_FILENAME))
+        for step in [destination_choice, balance_trips]]
+    assert dest_columns and balance_columns
+
+    assert zone_registry.referenced_zone_columns(['destination_choice']) == dest_columns
+    assert zone_registry.referenced_zone_columns(['destination_choice', 'balance_trips']) == \
+        dest_columns | balance_columns
+    assert zone_registry.referenced_zone_columns(['write_tables']) == set()
+
+
+def test_zones_cache(tmp_path, monkeypatch):
+
+    emp = pd.DataFrame({'zone': [1, 2, 3], 'totemp': [10., 0., 5.]})
+    setup_zone_files(tmp_path, {'emp.csv': emp,
+                                'hh.csv': pd.DataFrame({'zone': [1, 2, 3], 'hh': [1, 2, 3]})})
+    output_dir = tmp_path / 'output'
+    output_dir.mkdir()
+    injectables = {'data_dir': str(tmp_path), 'output_dir': str(output_dir)}
+
+    table_settings = {
+        zones.TABLE_FILENAMES_KEY: ['emp.csv', 'hh.csv'],
+        zones.ALL_COLUMNS_KEY: True,
+        zones.CACHE_KEY: True,
+    }
+    monkeypatch.setattr(config, 'read_model_settings', lambda file_name: table_settings)
+
+    reads = []
+    read_zone_tables = zones.read_zone_tables
+
+    def count_read_zone_tables(*args):
+        reads.append(args)
+        return read_zone_tables(*args)
+
+    monkeypatch.setattr(zones, 'read_zone_tables', count_read_zone_tables)
+
+    def read_zones():
+        # zones() registers the table it returns, so start from the decorated table again
+        inject.reinject_decorated_tables()
+        for name, value in injectables.items():
+            inject.add_injectable(name, value)
+        return zones.zones()
+
+    zones_df = read_zones()
+    assert len(reads) == 1
+    assert list(zones_df.columns) == ['totemp', 'hh']
+
+    assert read_zones().equals(zones_df)
+    assert len(reads) == 1
+
+    # changing a zone file invalidates the cache
+    hh = pd.DataFrame({'zone': [1, 2, 3], 'hh': [10, 20, 30]})
+    hh.to_csv(str(tmp_path / 'hh.csv'), index=False)
+    assert list(read_zones()['hh']) == [10, 20, 30]
+    assert len(reads) == 2
+
+
+def test_read_zone_tables_threads(tmp_path, monkeypatch):
+
+    zone_files = {'z%s.csv' % i: pd.DataFrame({'zone': [1, 2, 3], 'c%s' % i: [i, i + 1, i + 2]})
+                  for i in range(4)}
+    setup_zone_files(tmp_path, zone_files)
+
+    threads = set()
+    read_zone_indexed_csv_file = zones.read_zone_indexed_csv_file
+
+    def record_thread(*args):
+        threads.add(threading.current_thread().name)
+        return read_zone_indexed_csv_file(*args)
+
+    monkeypatch.setattr(zones, 'read_zone_indexed_csv_file', record_thread)
+
+    table_settings = {zones.TABLE_FILENAMES_KEY: sorted(zone_files), zones.READ_THREADS_KEY: 1}
+    serial = zones.read_zone_tables(table_settings)
+    assert threads == {threading.current_thread().name}
+
+    threads.clear()
+    table_settings[zones.READ_THREADS_KEY] = 3
+    threaded = zones.read_zone_tables(table_settings)
+    assert threading.current_thread().name not in threads
+
+    # tables are returned in file order
+    assert len(threaded) == len(serial)
+    for threaded_table, serial_table in zip(threaded, serial):
+        assert threaded_table.equals(serial_table)
@@ -0,0 +1,142 @@
+import hashlib
+import logging
+import os
+import pickle
+
+from activitysim.core import config
+from activitysim.core import inject
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR_KEY = 'cache_dir'
+CACHE_DIR_NAME = 'cache'
+DIGEST_CACHE_DIR = 'digests'
+
+
+def cache_dir(subdir=None):
+    """Directory for files cached between runs
+
+    Uses cache_dir from settings.yaml if given, otherwise a 'cache'
+    directory in the output directory. Created if it does not exist.
+
+    Parameters
+    ----------
+    subdir : str, optional
+        subdirectory for a particular kind of cached file
+
+    Returns
+    -------
+    str, directory path
+    """
+    dir_path = config.setting(CACHE_DIR_KEY)
+    if not dir_path:
+        dir_path = os.path.join(inject.get_injectable('output_dir'), CACHE_DIR_NAME)
+
+    if subdir:
+        dir_path = os.path.join(dir_path, subdir)
+
+    os.makedirs(dir_path, exist_ok=True)
+
+    return dir_path
+
+
+def file_digest(file_path, block_size=2**20):
+    """sha256 hex digest of a file's contents"""
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def dir_files(dir_path):
+    """Paths of the files in a directory and its subdirectories, sorted"""
+    return sorted(os.path.join(root, name)
+                  for root, _, names in os.walk(dir_path) for name in names)
+
+
+def cached_file_digest(file_path):
+    """file_digest, remembered between runs while the file's size and
+    modification time are unchanged
+
+    For a directory, the digest of the relative paths and contents of
+    all of its files, remembered while none of them change.
+    """
+    files = dir_files(file_path) if os.path.isdir(file_path) else [file_path]
+
+    signature = [os.path.abspath(file_path)]
+    for f in files:
+        stat = os.stat(f)
+        signature.extend([os.path.relpath(f, file_path), str(stat.st_size),
+                          str(stat.st_mtime_ns)])
+    signature = '\0'.join(signature)
+    key = hashlib.sha256(signature.encode('utf-8')).hexdigest()
+    digest_path = os.path.join(cache_dir(DIGEST_CACHE_DIR), '%s.txt' % key)
+
+    if os.path.isfile(digest_path):
+        with open(digest_path) as f:
+            return f.read().strip()
+
+    logger.info('hashing %s ...' % file_path)
+    if os.path.isdir(file_path):
+        h = hashlib.sha256()
+        for f in files:
+            h.update(('%s\0%s\0' % (os.path.relpath(f, file_path), file_digest(f)))
+                     .encode('utf-8'))
+        digest = h.hexdigest()
+    else:
+        digest = file_digest(file_path)
+    write_atomic(digest_path, lambda f: f.write(digest.encode('utf-8')))
+
+    return digest
+
+
+def load_or_evaluate(file_path, evaluate):
+    """Results pickled at file_path, or evaluated and then pickled there
+
+    Parameters
+    ----------
+    file_path : str or None
+        no caching if None
+    evaluate : callable
+        returns the results when they are not cached
+
+    Returns
+    -------
+    results of evaluate
+    """
+    if file_path and os.path.isfile(file_path):
+        try:
+            with open(file_path, 'rb') as f:
+                results = pickle.load(f)
+            logger.info('using cached %s' % file_path)
+            return results
+        except Exception as err:
+            logger.warning('could not read cache file %s: %s' % (file_path, err))
+
+    results = evaluate()
+
+    if file_path:
+        write_atomic(file_path, lambda f: pickle.dump(results, f, protocol=pickle.HIGHEST_PROTOCOL))
+
+    return results
+
+
+def write_atomic(file_path, write):
+    """Write a cache file so concurrent readers never see it half written
+
+    Parameters
+    ----------
+    file_path : str
+    write : callable
+        called with a binary file object to write the contents
+    """
+    tmp_path = '%s.%s.tmp' % (file_path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, file_path)
+    except Exception as err:
+        logger.warning('could not write cache file %s: %s' % (file_path, err))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -0,0 +1,170 @@
+import logging
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from asimtbm.utils import expressions
+
+logger = logging.getLogger(__name__)
+
+
+class ZoneVectors(object):
+    """Zone attribute accessor for dense expressions
+
+    zone_vectors['col'] returns the zone column as a broadcastable
+    vector: a column vector (zones x 1) for origin attributes and a
+    row vector (1 x zones) for destination attributes. numpy broadcasts
+    these against 2D orig x dest skims without materializing a copy
+    of the attribute for every zone pair.
+
+    Parameters
+    ----------
+    df : pandas DataFrame
+        zone attributes, rows in the same zone order as the skims
+    axis : int
+        0 for origin attributes, 1 for destination attributes
+    """
+
+    def __init__(self, df, axis):
+        assert axis in (0, 1)
+
+        self.df = df
+        self.axis = axis
+
+    def __getitem__(self, key):
+        values = self.df[key].values
+
+        if self.axis == 0:
+            return values[:, np.newaxis]
+
+        return values[np.newaxis, :]
+
+
+def is_temp_scalar(target):
+    return target.startswith('_') and target.isupper()
+
+
+def is_throwaway(target):
+    return target == '_'
+
+
+def is_temp(target):
+    return target.startswith('_')
+
+
+def evaluate_expressions(spec, locals_dict, shape, trace_pairs=None, plan=None):
+    """Dense equivalent of ActivitySim's assign.assign_variables
+
+    Evaluates each spec expression directly on numpy arrays. Skims are
+    2D orig x dest arrays and zone attributes broadcastable vectors, so
+    results are broadcast to orig x dest arrays rather than aligned on
+    a long-format pandas index. Target naming follows assign_variables:
+    '_' and '_UPPER' targets are scalar temps, '_lower' targets are
+    available to later expressions but not returned.
+
+    Parameters
+    ----------
+    spec : pandas DataFrame, assignment expressions
+    locals_dict : dict
+        dictionary containing constants, skims and zone vectors
+    shape : tuple
+        (num orig zones, num dest zones)
+    trace_pairs : tuple of (orig positions, dest positions) or None
+    plan : expressions.SpecPlan, optional
+        compiled spec. compiled here if not given.
+
+    Returns
+    -------
+    od_arrays : OrderedDict
+        target name: orig x dest array (possibly a read-only broadcast view)
+    trace_results : OrderedDict or None
+        target name: values at trace_pairs
+    """
+    if plan is None:
+        plan = expressions.compile_spec(spec)
+
+    _locals_dict = {'np': np, 'pd': pd}
+    _locals_dict.update(locals_dict)
+
+    od_arrays = OrderedDict()
+    trace_results = OrderedDict() if trace_pairs is not None else None
+
+    for target, values in plan.run(_locals_dict):
+
+        # later expressions can reference previously assigned targets
+        _locals_dict[target] = values
+
+        if is_temp_scalar(target) or is_throwaway(target):
+            continue
+
+        values = np.broadcast_to(np.asanyarray(values), shape)
+
+        if not is_temp(target):
+            od_arrays[target] = values
+
+        if trace_results is not None:
+            trace_results[target] = values[trace_pairs]
+
+    return od_arrays, trace_results
+
+
+def to_long(od_arrays, od_index):
+    """Convert dense orig x dest arrays to a long-format DataFrame
+
+    Parameters
+    ----------
+    od_arrays : dict
+        column name: orig x dest array
+    od_index : pandas MultiIndex
+        orig-major index matching the flattened arrays
+
+    Returns
+    -------
+    pandas DataFrame
+    """
+    return pd.DataFrame(OrderedDict(
+        (name, np.ravel(values)) for name, values in od_arrays.items()),
+        index=od_index)
+
+
+def sum_by_orig(od_arrays, zone_index):
+    """Sum each dense array over destinations
+
+    Parameters
+    ----------
+    od_arrays : dict
+        column name: orig x dest array
+    zone_index : pandas Index
+        origin zone ids
+
+    Returns
+    -------
+    pandas DataFrame indexed by 'orig'
+    """
+    index = pd.Index(zone_index, name='orig')
+
+    return pd.DataFrame(OrderedDict(
+        (name, values.sum(axis=1)) for name, values in od_arrays.items()),
+        index=index)
+
+
+def sum_by_dest(od_arrays, zone_index):
+    """Sum each dense array over origins
+
+    Parameters
+    ----------
+    od_arrays : dict
+        column name: orig x dest array
+    zone_index : pandas Index
+        destination zone ids
+
+    Returns
+    -------
+    pandas DataFrame indexed by 'dest'
+    """
+    index = pd.Index(zone_index, name='dest')
+
+    return pd.DataFrame(OrderedDict(
+        (name, values.sum(axis=0)) for name, values in od_arrays.items()),
+        index=index)
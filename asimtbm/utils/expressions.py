@@ -0,0 +1,362 @@
+import ast
+import hashlib
+import logging
+import marshal
+import os
+import pickle
+from collections import Counter
+from collections import OrderedDict
+from importlib.util import MAGIC_NUMBER
+
+from asimtbm.utils import cache
+
+logger = logging.getLogger(__name__)
+
+PLAN_CACHE_DIR = 'spec_plans'
+PLAN_VERSION = 1
+CSE_PREFIX = '_cse_'
+
+# expression nodes worth evaluating once when repeated
+CSE_NODES = (ast.Call, ast.Subscript, ast.BinOp, ast.UnaryOp, ast.Compare, ast.BoolOp)
+
+# nodes that bind their own names, so their subexpressions are not hoisted
+SCOPE_NODES = (ast.Lambda, ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
+
+
+class SpecPlan(object):
+    """Expressions of a spec file compiled for repeated evaluation
+
+    Each expression is parsed once and compiled to a code object.
+    Subexpressions that appear more than once and do not depend on
+    spec targets, such as skims['DIST'] or log(dest_zone['totemp']),
+    are hoisted into temps that are evaluated just before their first
+    use and released after their last.
+
+    Parameters
+    ----------
+    targets : list of str
+    expressions : list of str
+        original expression strings, used in error messages
+    codes : list of code objects
+        compiled expressions, after common subexpression elimination
+    temps : list of (name, code object)
+        hoisted subexpressions, in evaluation order
+    references : dict
+        local name: sorted list of string keys it is subscripted with,
+        e.g. {'skims': ['mf3'], 'dest_zone': ['ltpkg', 'totemp']}
+    names : list of str
+        all names read by the expressions
+    """
+
+    def __init__(self, targets, expressions, codes, temps, references, names):
+        self.targets = targets
+        self.expressions = expressions
+        self.codes = codes
+        self.temps = temps
+        self.references = references
+        self.names = names
+
+        self._schedule()
+
+    def _schedule(self):
+        """Work out when each temp is first and last needed"""
+        temp_names = [name for name, _ in self.temps]
+        temp_deps = {name: set(code.co_names) & set(temp_names) for name, code in self.temps}
+
+        def needed(code):
+            found = set(code.co_names) & set(temp_names)
+            pending = list(found)
+            while pending:
+                for dep in temp_deps[pending.pop()]:
+                    if dep not in found:
+                        found.add(dep)
+                        pending.append(dep)
+            return found
+
+        uses = [needed(code) for code in self.codes]
+        first_use = {}
+        last_use = {}
+        for i, used in enumerate(uses):
+            for name in used:
+                first_use.setdefault(name, i)
+                last_use[name] = i
+
+        self.temps_before = [
+            [(name, code) for name, code in self.temps if first_use.get(name) == i]
+            for i in range(len(self.codes))]
+        self.release_after = [
+            [name for name in temp_names if last_use.get(name) == i]
+            for i in range(len(self.codes))]
+
+    def run(self, locals_dict):
+        """Evaluate the expressions in order
+
+        Hoisted temps are added to and removed from locals_dict as needed.
+        Assigning each target back to locals_dict, so later expressions
+        can reference it, is left to the caller.
+
+        Parameters
+        ----------
+        locals_dict : dict
+
+        Returns
+        -------
+        generator of (target, values)
+        """
+        for i, (target, code) in enumerate(zip(self.targets, self.codes)):
+            try:
+                for name, temp_code in self.temps_before[i]:
+                    locals_dict[name] = eval(temp_code, {}, locals_dict)
+
+                values = eval(code, {}, locals_dict)
+            except Exception as err:
+                logger.error("expression evaluation error: %s target: %s expression: %s"
+                             % (type(err).__name__, target, self.expressions[i]))
+                raise err
+
+            for name in self.release_after[i]:
+                del locals_dict[name]
+
+            yield target, values
+
+    def to_dict(self):
+        return {
+            'version': PLAN_VERSION,
+            'targets': self.targets,
+            'expressions': self.expressions,
+            'codes': [marshal.dumps(code) for code in self.codes],
+            'temps': [(name, marshal.dumps(code)) for name, code in self.temps],
+            'references': self.references,
+            'names': self.names,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(targets=d['targets'],
+                   expressions=d['expressions'],
+                   codes=[marshal.loads(code) for code in d['codes']],
+                   temps=[(name, marshal.loads(code)) for name, code in d['temps']],
+                   references=d['references'],
+                   names=d['names'])
+
+
+def subscript_key(node):
+    """String key of a subscript like skims['DIST'] or None"""
+    key = node.slice
+    if hasattr(ast, 'Index') and isinstance(key, ast.Index):  # python < 3.9
+        key = key.value
+    value = getattr(key, 'value', getattr(key, 's', None))  # ast.Constant or ast.Str
+    return value if isinstance(value, str) else None
+
+
+def walk_expression(node):
+    """ast.walk that does not descend into lambdas or comprehensions"""
+    pending = [node]
+    while pending:
+        node = pending.pop()
+        yield node
+        if not isinstance(node, SCOPE_NODES):
+            pending.extend(ast.iter_child_nodes(node))
+
+
+def find_references(trees):
+    """Names read by the expressions and the string keys they are subscripted with
+
+    Returns
+    -------
+    references : dict of name: sorted list of keys
+    names : sorted list of names
+    """
+    references = {}
+    names = set()
+    for tree in trees:
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name):
+                names.add(node.id)
+            if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name):
+                key = subscript_key(node)
+                if key is not None:
+                    references.setdefault(node.value.id, set()).add(key)
+
+    references = {name: sorted(keys) for name, keys in references.items()}
+    return references, sorted(names)
+
+
+def expression_references(expressions):
+    """find_references for a list of expression strings"""
+    return find_references([ast.parse(expression, mode='eval') for expression in expressions])
+
+
+class _Replace(ast.NodeTransformer):
+
+    def __init__(self, dump, name):
+        self.dump = dump
+        self.name = name
+
+    def generic_visit(self, node):
+        if isinstance(node, SCOPE_NODES):
+            return node
+        if isinstance(node, ast.expr) and ast.dump(node) == self.dump:
+            return ast.copy_location(ast.Name(id=self.name, ctx=ast.Load()), node)
+        return super(_Replace, self).generic_visit(node)
+
+
+def eliminate_common_subexpressions(trees, targets):
+    """Hoist repeated subexpressions out of the expression trees
+
+    The largest repeated subexpression is hoisted first, until none
+    are repeated. Subexpressions reading spec targets are left in place
+    since their values depend on the order of evaluation.
+
+    Parameters
+    ----------
+    trees : list of ast.Expression, modified in place
+    targets : list of str
+
+    Returns
+    -------
+    list of (name, ast.Expression) temps in evaluation order
+    """
+    targets = set(targets)
+    temps = []
+
+    def candidates(tree):
+        for node in walk_expression(tree.body):
+            if not isinstance(node, CSE_NODES):
+                continue
+            nodes = list(walk_expression(node))
+            if any(isinstance(n, SCOPE_NODES) for n in nodes):
+                continue
+            if any(isinstance(n, ast.Name) and n.id in targets for n in nodes):
+                continue
+            yield ast.dump(node), len(nodes)
+
+    while True:
+        counts = Counter()
+        sizes = {}
+        for tree in trees + [temp for _, temp in temps]:
+            for dump, size in candidates(tree):
+                counts[dump] += 1
+                sizes[dump] = size
+
+        repeated = [dump for dump, count in counts.items() if count > 1]
+        if not repeated:
+            break
+
+        dump = max(repeated, key=lambda d: sizes[d])
+        name = '%s%s' % (CSE_PREFIX, len(temps))
+
+        node = None
+        for tree in trees + [temp for _, temp in temps]:
+            for n in walk_expression(tree.body):
+                if isinstance(n, ast.expr) and ast.dump(n) == dump:
+                    node = n
+                    break
+            if node is not None:
+                break
+
+        replace = _Replace(dump, name)
+        for tree in trees + [temp for _, temp in temps]:
+            replace.visit(tree)
+            ast.fix_missing_locations(tree)
+
+        temp = ast.fix_missing_locations(ast.Expression(body=node))
+        temps.append((name, temp))
+
+    # order temps so each is evaluated after the temps it uses
+    temp_trees = OrderedDict(temps)
+    ordered = []
+
+    def visit(name):
+        if name in ordered:
+            return
+        for node in walk_expression(temp_trees[name].body):
+            if isinstance(node, ast.Name) and node.id in temp_trees:
+                visit(node.id)
+        ordered.append(name)
+
+    for name in temp_trees:
+        visit(name)
+
+    return [(name, temp_trees[name]) for name in ordered]
+
+
+def compile_spec(spec):
+    """Compile spec expressions into a SpecPlan
+
+    Parameters
+    ----------
+    spec : pandas DataFrame, assignment expressions
+
+    Returns
+    -------
+    SpecPlan
+    """
+    targets = list(spec.target)
+    expressions = list(spec.expression)
+
+    trees = []
+    for target, expression in zip(targets, expressions):
+        try:
+            trees.append(ast.parse(expression, mode='eval'))
+        except SyntaxError as err:
+            logger.error("could not parse expression for target %s: %s" % (target, expression))
+            raise err
+
+    references, names = find_references(trees)
+
+    temps = eliminate_common_subexpressions(trees, targets)
+    if temps:
+        logger.debug('hoisted %s common subexpressions from spec' % len(temps))
+
+    codes = [compile(tree, '<expression %s>' % target, 'eval')
+             for target, tree in zip(targets, trees)]
+    temps = [(name, compile(tree, '<%s>' % name, 'eval')) for name, tree in temps]
+
+    return SpecPlan(targets, expressions, codes, temps, references, names)
+
+
+def spec_hash(spec):
+    """Hash of the spec targets and expressions
+
+    Coefficient columns are not included, so editing coefficients
+    does not change the hash.
+    """
+    h = hashlib.sha256()
+    for target, expression in zip(spec.target, spec.expression):
+        h.update(('%s\0%s\0' % (target, expression)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def load_spec_plan(spec):
+    """Compiled SpecPlan for spec, cached on disk between runs
+
+    Plans are keyed by the hash of the spec expressions and the
+    python bytecode version.
+
+    Parameters
+    ----------
+    spec : pandas DataFrame, assignment expressions
+
+    Returns
+    -------
+    SpecPlan
+    """
+    key = '%s-%s-%s' % (spec_hash(spec), MAGIC_NUMBER.hex(), PLAN_VERSION)
+    file_path = os.path.join(cache.cache_dir(PLAN_CACHE_DIR), '%s.pkl' % key)
+
+    if os.path.isfile(file_path):
+        try:
+            with open(file_path, 'rb') as f:
+                plan = SpecPlan.from_dict(pickle.load(f))
+            logger.info('using cached spec plan %s' % file_path)
+            return plan
+        except Exception as err:
+            logger.warning('could not read cached spec plan %s: %s' % (file_path, err))
+
+    plan = compile_spec(spec)
+
+    cache.write_atomic(file_path, lambda f: pickle.dump(plan.to_dict(), f))
+    logger.info('cached spec plan %s' % file_path)
+
+    return plan
@@ -1,17 +1,50 @@
 import logging
 import numpy as np
-from ipfn import ipfn
+import pandas as pd
 
 from activitysim.core import tracing
 
 
 logger = logging.getLogger(__name__)
 
+IPF_METHOD = 'ipf'
+ANDERSON_METHOD = 'anderson'
+
+# number of previous iterations used by anderson acceleration
+ANDERSON_MEMORY = 5
+
 
 class Balancer():
-    """Wrapper for the IPFN matrix balancer
-    https://github.com/Dirguis/ipfn
+    """Iterative proportional fitting (IPF) matrix balancer
+
+    Follows the algorithm and stopping criteria of the IPFN matrix
+    balancer (https://github.com/Dirguis/ipfn), but on a dense numpy
+    array with one axis for each dimension column of df rather than on
+    the long DataFrame. Marginal sums are axis reductions and each
+    aggregate's factors are applied in place by broadcasting.
+
+    With sparse=True only the nonzero cells are stored, in a flat
+    array. Marginal sums are then scatter-adds (bincount) of the cells
+    into their aggregate groups and factors are gathered back, so memory
+    and time scale with the number of nonzero cells. IPF never changes
+    a zero cell, so both give the same results.
 
+    Each iteration scales the array to match each aggregate in turn.
+    Iterations stop once the largest relative difference between the
+    array sums and the aggregates is below convergence_rate, changes by
+    less than closure between iterations, or after max_iteration
+    iterations.
+
+    method='anderson' speeds up convergence with Anderson acceleration
+    of the log factors of each aggregate, see anderson_iteration. It
+    usually needs far fewer iterations for the same closure.
+
+    The factors applied for each aggregate are kept in factors, see
+    balancing_factors. Passing the factors of a previous balance as
+    initial_factors starts from the seed scaled by them, which takes
+    only a few iterations when the aggregates changed little. They are
+    ignored unless indexed by the same levels as this balance's
+    aggregates.
 
     Parameters
     ----------
@@ -27,6 +60,15 @@ class Balancer():
         to qualify as a change in convergence ratio
     closure : difference between convergence rate of two consecutive
         iterations to stop algorithm
+    sparse : bool
+        store only the nonzero cells
+    method : str
+        'ipf' (default) or 'anderson'
+    trace_label : str, optional
+        prefix of the balancing info file written if balancing fails
+        to converge. weight_col if not given.
+    initial_factors : list of pandas Series, optional
+        balancing_factors of a previous balance, to start from
 
 
     Returns
@@ -41,7 +83,16 @@ class Balancer():
                  weight_col,
                  convergence_rate=1e-6,
                  max_iteration=50,
-                 closure=1e-4):
+                 closure=1e-4,
+                 sparse=False,
+                 method=IPF_METHOD,
+                 trace_label=None,
+                 initial_factors=None):
+
+        assert len(aggregates) == len(dimensions)
+        if method not in [IPF_METHOD, ANDERSON_METHOD]:
+            raise RuntimeError("balancing method must be one of %s"
+                               % [IPF_METHOD, ANDERSON_METHOD])
 
         self.df = df
         self.aggregates = aggregates
@@ -50,17 +101,392 @@ class Balancer():
         self.convergence_rate = convergence_rate
         self.max_iteration = max_iteration
         self.closure = closure
+        self.sparse = sparse
+        self.method = method
+        self.trace_label = trace_label or weight_col
+
+        self.columns = []
+        for features in dimensions:
+            self.columns.extend(f for f in features if f not in self.columns)
+
+        if sparse:
+            self.seed = self.sparse_seed()
+        else:
+            self.seed = self.dense_seed()
+
+        self.axes = []
+        self.sum_axes = []
+        self.groups = []
+        self.targets = []
+        for aggregate, features in zip(aggregates, dimensions):
+            axes = [self.columns.index(f) for f in features]
+            self.axes.append(axes)
+            self.sum_axes.append(tuple(a for a in range(len(self.columns)) if a not in axes))
+            if sparse:
+                self.groups.append(np.ravel_multi_index([self.codes[a] for a in axes],
+                                                        [len(self.levels[a]) for a in axes]))
+                self.targets.append(self.sparse_target(aggregate, axes, self.groups[-1]))
+            else:
+                self.targets.append(self.dense_target(aggregate, axes))
+
+        self.initial_factors = self.factor_arrays(initial_factors)
+
+    def df_cells(self):
+        """Sets the levels of each dimension column and returns the
+        flat cell number of each df row in the dense array
+        """
+        codes = []
+        self.levels = []
+        for col in self.columns:
+            col_codes, col_levels = pd.factorize(self.df[col], sort=True)
+            codes.append(col_codes)
+            self.levels.append(col_levels)
+
+        self.shape = tuple(len(levels) for levels in self.levels)
+
+        return np.ravel_multi_index(codes, self.shape)
+
+    def dense_seed(self):
+        """Arrange the df weights in an array with an axis per dimension column
+
+        Sets the zone levels of each axis and the array cell of each df row.
+        Rows with the same dimension values are summed into one cell.
+
+        Returns
+        -------
+        numpy array
+        """
+        self.cells = self.df_cells()
+
+        weights = self.df[self.weight_col].values.astype(np.float64)
+        seed = np.bincount(self.cells, weights=weights, minlength=int(np.prod(self.shape)))
+
+        return seed.reshape(self.shape)
+
+    def sparse_seed(self):
+        """The nonzero cells of dense_seed, in a flat array
+
+        Sets the levels of each dimension column, the dimension codes of
+        each nonzero cell and the nonzero cell of each df row (-1 for
+        rows without weight).
+
+        Returns
+        -------
+        numpy array
+        """
+        cells = self.df_cells()
+
+        weights = self.df[self.weight_col].values.astype(np.float64)
+        nonzero = weights != 0
+
+        unique_cells, inverse = np.unique(cells[nonzero], return_inverse=True)
+        self.cells = np.full(len(cells), -1, dtype=np.int64)
+        self.cells[nonzero] = inverse
+        self.codes = np.unravel_index(unique_cells, self.shape)
+
+        return np.bincount(inverse, weights=weights[nonzero], minlength=len(unique_cells))
+
+    def aggregate_index(self, axes):
+        """Index of every combination of the levels of axes"""
+        if len(axes) == 1:
+            return pd.Index(self.levels[axes[0]], name=self.columns[axes[0]])
+
+        return pd.MultiIndex.from_product([self.levels[a] for a in axes],
+                                          names=[self.columns[a] for a in axes])
+
+    def aggregate_values(self, aggregate, axes):
+        """Aggregate values for every combination of the levels of axes,
+        NaN where missing
+        """
+        return aggregate.reindex(self.aggregate_index(axes)).values.astype(np.float64)
+
+    def dense_values(self, values, axes):
+        """Flat values of aggregate_index(axes) as an array broadcastable
+        against the seed
+        """
+        values = values.reshape([len(self.levels[a]) for a in axes])
+
+        # order the axes like the seed's and add the summed axes
+        values = np.transpose(values, np.argsort(axes))
+
+        return values.reshape([len(self.levels[a]) if a in axes else 1
+                               for a in range(len(self.columns))])
+
+    def dense_target(self, aggregate, axes):
+        """Aggregate as an array broadcastable against the seed
+
+        Parameters
+        ----------
+        aggregate : pandas Series
+            indexed by the dimension values of axes, in the same order
+        axes : list of int
+
+        Returns
+        -------
+        numpy array with the seed's number of dimensions
+        """
+        target = self.dense_values(self.aggregate_values(aggregate, axes), axes)
+
+        missing = np.isnan(target)
+        if missing.any():
+            other_axes = tuple(a for a in range(self.seed.ndim) if a not in axes)
+            if (self.seed.sum(axis=other_axes, keepdims=True)[missing] != 0).any():
+                raise RuntimeError("aggregate %s is missing targets for some %s"
+                                   % (aggregate.name, [self.columns[a] for a in axes]))
+            target[missing] = 0
+
+        return target
+
+    def sparse_target(self, aggregate, axes, groups):
+        """Aggregate as a flat array indexed by the sparse cell groups
+
+        Parameters
+        ----------
+        aggregate : pandas Series
+            indexed by the dimension values of axes, in the same order
+        axes : list of int
+        groups : numpy array
+            aggregate group of each nonzero cell
+
+        Returns
+        -------
+        numpy array
+        """
+        target = self.aggregate_values(aggregate, axes)
+
+        missing = np.isnan(target)
+        if missing.any():
+            if missing[groups].any():
+                raise RuntimeError("aggregate %s is missing targets for some %s"
+                                   % (aggregate.name, [self.columns[a] for a in axes]))
+            target[missing] = 0
+
+        return target
+
+    def factor_arrays(self, initial_factors):
+        """initial_factors arranged like the targets
+
+        Factors that are not positive and finite are reset to one, so
+        the aggregates they zeroed can be matched again.
+
+        Returns
+        -------
+        list of numpy arrays, or None if initial_factors is None or not
+        indexed like the aggregates
+        """
+        if initial_factors is None:
+            return None
+
+        if len(initial_factors) != len(self.targets) or \
+                not all(factors.index.equals(self.aggregate_index(axes))
+                        for factors, axes in zip(initial_factors, self.axes)):
+            logger.info('%s initial factors do not match the aggregates, balancing from the seed'
+                        % self.trace_label)
+            return None
+
+        arrays = []
+        for factors, axes in zip(initial_factors, self.axes):
+            values = factors.values.astype(np.float64)
+            values[~(np.isfinite(values) & (values > 0))] = 1
+            arrays.append(values if self.sparse else self.dense_values(values, axes))
+
+        return arrays
+
+    def start(self, base):
+        """Reset the factors to the initial factors and scale base by them
+
+        Returns
+        -------
+        numpy array, a scaled copy of base
+        """
+        if self.initial_factors is None:
+            self.factors = [np.ones_like(target) for target in self.targets]
+            return base.copy()
+
+        logger.info('%s balancing starts from initial factors' % self.trace_label)
+        self.factors = [factors.copy() for factors in self.initial_factors]
+
+        return self.scaled(base, [np.log(factors) for factors in self.factors])
+
+    def balancing_factors(self):
+        """Total factor applied to the seed for each aggregate
+
+        The balanced array is the seed times the factors of its group in
+        each aggregate. Factors of groups without seed weight are arbitrary.
+
+        Returns
+        -------
+        list of pandas Series indexed like the aggregates
+        """
+        series = []
+        for factors, axes in zip(self.factors, self.axes):
+            if not self.sparse:
+                # undo dense_values
+                seed_axes = sorted(axes)
+                factors = factors.reshape([len(self.levels[a]) for a in seed_axes])
+                factors = np.transpose(factors, [seed_axes.index(a) for a in axes])
+            series.append(pd.Series(factors.ravel(), index=self.aggregate_index(axes)))
+
+        return series
+
+    def margin(self, m, k):
+        """Sums of m over the dimensions not in aggregate k"""
+        if self.sparse:
+            return np.bincount(self.groups[k], weights=m, minlength=len(self.targets[k]))
+
+        return m.sum(axis=self.sum_axes[k], keepdims=True)
+
+    def fit(self, m):
+        """Scale m in place to match each aggregate in turn"""
+        for k, target in enumerate(self.targets):
+            sums = self.margin(m, k)
+
+            # ipfn multiplies by the target where the sums are zero
+            factors = target.copy()
+            np.divide(target, sums, out=factors, where=sums != 0)
+
+            m *= self.expand(k, factors)
+            self.factors[k] *= factors
+
+    def expand(self, k, values):
+        """Values of the groups of aggregate k for each cell (broadcastable if dense)"""
+        if self.sparse:
+            return values[self.groups[k]]
+
+        return values
+
+    def convergence(self, m):
+        """Largest relative difference between the sums of m and the aggregates"""
+        conv = 0
+        for k, target in enumerate(self.targets):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                diff = np.abs(self.margin(m, k) / target - 1)
+            diff = diff[~np.isnan(diff)]
+            if diff.size:
+                conv = max(conv, diff.max())
+
+        return conv
+
+    def scaled(self, base, log_factors):
+        """base scaled by the factors of each aggregate"""
+        log_scale = np.zeros_like(base)
+        for k, u in enumerate(log_factors):
+            log_scale += self.expand(k, u)
 
-        self.ipfn = ipfn.ipfn(
-            self.df,
-            self.aggregates,
-            self.dimensions,
-            weight_col=self.weight_col,
-            convergence_rate=self.convergence_rate,
-            max_iteration=self.max_iteration,
-            rate_tolerance=self.closure,
-            verbose=2
-        )
+        return base * np.exp(log_scale)
+
+    def anderson_iteration(self):
+        """iteration with Anderson acceleration
+
+        The state is the log factors of every aggregate, which IPF
+        iterations update as a fixed point iteration. Each iteration runs
+        one IPF iteration from the current factors, then extrapolates from
+        the changes in the last ANDERSON_MEMORY iterations (Anderson type
+        II). The extrapolated factors are used unless the plain IPF
+        iteration gets closer to the aggregates, which restarts the history.
+
+        Cells in groups with a zero target are zeroed first, as IPF does
+        in its first iteration, so every factor stays finite.
+
+        Returns
+        -------
+        see iteration
+        """
+        base = self.seed.copy()
+        for k, target in enumerate(self.targets):
+            base *= self.expand(k, target != 0)
+
+        shapes = [target.shape for target in self.targets]
+        splits = np.cumsum([target.size for target in self.targets])[:-1]
+
+        def unflatten(x):
+            return [u.reshape(shape) for u, shape in zip(np.split(x, splits), shapes)]
+
+        m = self.start(base)
+        x = np.concatenate([np.log(factors).ravel() for factors in self.factors])
+
+        i = 0
+        conv = np.inf
+        old_conv = -np.inf
+        conv_list = []
+        x_diffs, g_diffs = [], []
+        prev_f = prev_g = None
+        while i <= self.max_iteration and conv > self.convergence_rate \
+                and abs(conv - old_conv) > self.closure:
+            old_conv = conv
+
+            # plain IPF iteration, in log factors
+            log_factors = unflatten(x)
+            for k, target in enumerate(self.targets):
+                sums = self.margin(m, k)
+                ratio = np.ones_like(target)
+                np.divide(target, sums, out=ratio, where=(sums > 0) & (target > 0))
+                m *= self.expand(k, ratio)
+                log_factors[k] = log_factors[k] + np.log(ratio)
+            g = np.concatenate([u.ravel() for u in log_factors])
+            conv = self.convergence(m)
+
+            f = g - x
+            if prev_f is not None:
+                x_diffs.append(f - prev_f)
+                g_diffs.append(g - prev_g)
+                x_diffs, g_diffs = x_diffs[-ANDERSON_MEMORY:], g_diffs[-ANDERSON_MEMORY:]
+            prev_f, prev_g = f, g
+            x = g
+
+            if x_diffs:
+                gamma = np.linalg.lstsq(np.column_stack(x_diffs), f, rcond=None)[0]
+                x_accel = g - np.column_stack(g_diffs).dot(gamma)
+                m_accel = self.scaled(base, unflatten(x_accel))
+                conv_accel = self.convergence(m_accel)
+                if conv_accel < conv:
+                    x, m, conv = x_accel, m_accel, conv_accel
+                else:
+                    x_diffs, g_diffs = [], []
+
+            conv_list.append(conv)
+            i += 1
+
+        self.factors = [np.exp(u) * (target != 0) for u, target in zip(unflatten(x), self.targets)]
+
+        converged = i <= self.max_iteration
+        info_df = pd.DataFrame({'iteration': range(i), 'conv': conv_list}).set_index('iteration')
+
+        return m, converged, info_df
+
+    def iteration(self):
+        """Run IPF iterations until converged
+
+        Returns
+        -------
+        m : numpy array
+            balanced array
+        converged : bool
+            False if stopped by max_iteration
+        info_df : pandas DataFrame
+            convergence rate 'conv' of each 'iteration'
+        """
+        if self.method == ANDERSON_METHOD:
+            return self.anderson_iteration()
+
+        m = self.start(self.seed)
+
+        i = 0
+        conv = np.inf
+        old_conv = -np.inf
+        conv_list = []
+        while i <= self.max_iteration and conv > self.convergence_rate \
+                and abs(conv - old_conv) > self.closure:
+            old_conv = conv
+            self.fit(m)
+            conv = self.convergence(m)
+            conv_list.append(conv)
+            i += 1
+
+        converged = i <= self.max_iteration
+        info_df = pd.DataFrame({'iteration': range(i), 'conv': conv_list}).set_index('iteration')
+
+        return m, converged, info_df
 
     def balance(self):
         """Run an iteration of the balancer
@@ -70,15 +496,26 @@ class Balancer():
         Balanced pandas DataFrame
         """
 
-        balanced_df, converged, info_df = self.ipfn.iteration()
+        m, converged, info_df = self.iteration()
 
-        if not converged == 1:
+        if not converged:
             logger.warning('matrix balance failed to converge. See trace output table.')
-            filename = self.weight_col + '_balancing_info'
+            filename = self.trace_label + '_balancing_info'
             tracing.write_csv(info_df, filename, transpose=False)
         else:
             conv = info_df.iloc[-1]['conv']
             logger.info('success! matrix dimension difference converged to %s in %s iterations.'
                         % (conv, info_df.shape[0]))
 
+        # rows sharing a cell are scaled by the cell's factor
+        scale = np.zeros_like(m)
+        np.divide(m, self.seed, out=scale, where=self.seed != 0)
+
+        row_scale = scale.ravel()[self.cells]
+        if self.sparse:
+            row_scale[self.cells < 0] = 0
+
+        balanced_df = self.df.copy()
+        balanced_df[self.weight_col] = self.df[self.weight_col].values * row_scale
+
         return balanced_df
@@ -0,0 +1,202 @@
+import logging
+import os
+from collections import OrderedDict
+
+import numpy as np
+import openmatrix as omx
+
+logger = logging.getLogger(__name__)
+
+ZARR_SUFFIX = '.zarr'
+DATA_DIR = 'data'
+LOOKUP_DIR = 'lookup'
+
+# rows per chunk of converted skims, if not given
+CHUNK_ROWS = 256
+
+
+class NpySkimsFile(object):
+    """Skims stored as a directory of .npy files
+
+    The same layout as omx files: data/<matrix>.npy for each matrix and
+    lookup/<mapping>.npy for the zone ids of each mapping. Matrices are
+    memory-mapped, so any number of processes can read them at once,
+    and reading a block of rows only reads those rows from disk.
+
+    Implements the parts of the openmatrix File interface used by
+    Skims.
+
+    Parameters
+    ----------
+    dir_path : str
+    """
+
+    # see Skims.reads_row_blocks
+    reads_row_blocks = True
+
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+
+        self.files = OrderedDict()
+        for folder in [DATA_DIR, LOOKUP_DIR]:
+            folder_path = os.path.join(dir_path, folder)
+            names = sorted(os.listdir(folder_path)) if os.path.isdir(folder_path) else []
+            self.files[folder] = OrderedDict(
+                (name[:-len('.npy')], os.path.join(folder_path, name))
+                for name in names if name.endswith('.npy'))
+
+        if not self.files[DATA_DIR]:
+            raise RuntimeError("no matrices found in %s" % os.path.join(dir_path, DATA_DIR))
+
+    def shape(self):
+        return self[self.listMatrices()[0]].shape
+
+    def listMatrices(self):
+        return list(self.files[DATA_DIR])
+
+    def list_mappings(self):
+        return list(self.files[LOOKUP_DIR])
+
+    def mapping(self, title):
+        zones = np.load(self.files[LOOKUP_DIR][title])
+        return OrderedDict((zone, i) for i, zone in enumerate(zones.tolist()))
+
+    def __getitem__(self, key):
+        return np.load(self.files[DATA_DIR][key], mmap_mode='r')
+
+    def close(self):
+        pass
+
+
+class ZarrSkimsFile(object):
+    """Skims stored in a zarr directory store
+
+    The same layout as omx files: data/<matrix> arrays and lookup/<mapping>
+    zone id arrays. Matrices are compressed in chunks of rows, and can be
+    read by any number of processes at once without file locking.
+
+    Implements the parts of the openmatrix File interface used by
+    Skims. Requires the zarr package.
+
+    Parameters
+    ----------
+    store_path : str
+    """
+
+    reads_row_blocks = True
+
+    def __init__(self, store_path):
+        zarr = import_zarr()
+
+        self.store_path = store_path
+        self.group = zarr.open_group(store_path, mode='r')
+
+    def _keys(self, folder):
+        if folder not in self.group:
+            return []
+        return sorted(self.group[folder].array_keys())
+
+    def shape(self):
+        return self[self.listMatrices()[0]].shape
+
+    def listMatrices(self):
+        return self._keys(DATA_DIR)
+
+    def list_mappings(self):
+        return self._keys(LOOKUP_DIR)
+
+    def mapping(self, title):
+        zones = self.group[LOOKUP_DIR][title][:]
+        return OrderedDict((zone, i) for i, zone in enumerate(zones.tolist()))
+
+    def __getitem__(self, key):
+        return self.group[DATA_DIR][key]
+
+    def close(self):
+        pass
+
+
+def import_zarr():
+    try:
+        import zarr
+    except ImportError:
+        raise RuntimeError("reading or writing %s skims requires the zarr package"
+                           % ZARR_SUFFIX)
+    return zarr
+
+
+def open_skims_file(file_path):
+    """Open a skims file in the format given by its path
+
+    Parameters
+    ----------
+    file_path : str
+        a zarr store ending in .zarr, a directory of .npy files
+        (see NpySkimsFile) or an omx file
+
+    Returns
+    -------
+    file object with the openmatrix File interface used by Skims
+    """
+    if file_path.rstrip('/\\').endswith(ZARR_SUFFIX):
+        return ZarrSkimsFile(file_path)
+
+    if os.path.isdir(file_path):
+        return NpySkimsFile(file_path)
+
+    return omx.open_file(file_path, 'r')
+
+
+def convert_omx(omx_file_path, out_path, chunk_rows=CHUNK_ROWS):
+    """Convert an omx file to a zarr store or a directory of .npy files
+
+    Matrices are copied a block of rows at a time, so the whole matrix
+    is never in memory. Zone mappings are copied as well.
+
+    Parameters
+    ----------
+    omx_file_path : str
+    out_path : str
+        zarr store if it ends in .zarr, otherwise a directory of .npy files
+    chunk_rows : int
+        rows per zarr chunk and per block copied
+    """
+    as_zarr = out_path.rstrip('/\\').endswith(ZARR_SUFFIX)
+    if as_zarr:
+        zarr = import_zarr()
+        root = zarr.open_group(out_path, mode='w')
+    else:
+        for folder in [DATA_DIR, LOOKUP_DIR]:
+            os.makedirs(os.path.join(out_path, folder), exist_ok=True)
+
+    omx_file = omx.open_file(omx_file_path, 'r')
+    try:
+        for name in omx_file.listMatrices():
+            node = omx_file[name]
+            shape = tuple(int(s) for s in node.shape)
+
+            if as_zarr:
+                out = root.require_group(DATA_DIR).zeros(
+                    name, shape=shape, chunks=(chunk_rows, shape[1]), dtype=node.dtype)
+            else:
+                out = np.lib.format.open_memmap(
+                    os.path.join(out_path, DATA_DIR, '%s.npy' % name),
+                    mode='w+', dtype=node.dtype, shape=shape)
+
+            for start in range(0, shape[0], chunk_rows):
+                out[start:start + chunk_rows] = node[start:start + chunk_rows]
+
+            if not as_zarr:
+                out.flush()
+                del out
+
+            logger.info("converted %s %s from %s" % (name, shape, omx_file_path))
+
+        for title in omx_file.list_mappings():
+            zones = np.array(list(omx_file.mapping(title)))
+            if as_zarr:
+                root.require_group(LOOKUP_DIR).array(title, zones)
+            else:
+                np.save(os.path.join(out_path, LOOKUP_DIR, '%s.npy' % title), zones)
+    finally:
+        omx_file.close()
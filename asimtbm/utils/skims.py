@@ -1,24 +1,69 @@
 # This is a pared down version of the ODSkims code found in https://github.com/RSGInc/bca4abm
+import hashlib
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from os import path
-import openmatrix as omx
+
+import numpy as np
 
 from activitysim.core import skim as askim
 
+from asimtbm.utils import cache
+from asimtbm.utils import skim_files
+
 logger = logging.getLogger(__name__)
 
 SKIMS_KEY = 'aggregate_od_matrices'
+SKIM_CACHE_KEY = 'cache_skims'
+SKIM_CACHE_DIR = 'skims'
+PREFETCH_KEY = 'prefetch_skims'
+MAX_SKIM_MEMORY_KEY = 'max_skim_memory_mb'
+SKIM_DTYPES_KEY = 'skim_dtypes'
+
+# approximate size of each block of rows read by read_subset
+READ_BLOCK_BYTES = 64 * 2**20
 
 
-def read_skims(zone_index, data_dir, model_settings):
+def read_skims(zone_index, data_dir, model_settings, dense=False, references=None,
+               prefetch=True):
     """Reads OpenMatrix skims
 
+    Files in aggregate_od_matrices can also be zarr stores or directories
+    of .npy files, which several processes can read at once, see
+    skim_files.open_skims_file and skim_files.convert_omx. Blocks of
+    origin zones read only their rows of these, see SkimsBlock.
+
+    Skims read from all omx files are kept in one SkimCache, bounded by
+    max_skim_memory_mb if given. skim_dtypes converts skims to smaller
+    types as they are read, e.g. {'TIME': 'float32', 'TOLL_FLAG': 'int16'}.
+
+    If references are given, the referenced skims are read in background
+    threads, one per omx file, while expressions are evaluated. HDF5
+    decompression releases the GIL for much of the read. Accessing a skim
+    then only waits for that skim to be read. With a memory budget, only
+    the skims that fit in it are prefetched. Set prefetch_skims to False
+    in model_settings to read skims on first access instead.
+
     Parameters
     ----------
     zone_index : pandas Index obj
     data_dir : str
         data directory path
     model_settings : dict
+        with cache_skims: True, skim cores are read through a
+        memory-mapped cache, see Skims.read_cached
+    dense : bool
+        whether skims are returned as 2D orig x dest arrays
+        instead of flattened arrays
+    references : dict, optional
+        local name: keys used by the expressions. If given, omx files
+        no expression uses are not opened, and an error names any
+        referenced skims missing from the omx files.
+    prefetch : bool
+        False to not start reading the referenced skims, e.g. when the
+        results are already cached
 
     Returns
     -------
@@ -29,19 +74,119 @@ def read_skims(zone_index, data_dir, model_settings):
     if not aggregate_od_matrices:
         raise RuntimeError("No list %s found in model_settings", SKIMS_KEY)
 
+    max_skim_memory = model_settings.get(MAX_SKIM_MEMORY_KEY)
+    skim_cache = SkimCache(max_bytes=max_skim_memory * 2**20 if max_skim_memory else None)
+
+    dtypes = model_settings.get(SKIM_DTYPES_KEY) or {}
+    try:
+        dtypes = {key: np.dtype(dtype) for key, dtype in dtypes.items()}
+    except TypeError as err:
+        raise RuntimeError("invalid %s: %s" % (SKIM_DTYPES_KEY, err))
+
     skims_dict = {}
+    missing = []
     for local_name, omx_file_name in aggregate_od_matrices.items():
+        if references is not None and local_name not in references:
+            logger.info("skipping %s, which no expression uses" % omx_file_name)
+            continue
+
         omx_file_path = path.join(data_dir, omx_file_name)
 
         skims = Skims(name=local_name,
                       omx_file_path=omx_file_path,
-                      zone_index=zone_index)
+                      zone_index=zone_index,
+                      dense=dense,
+                      cache=model_settings.get(SKIM_CACHE_KEY, False),
+                      skim_cache=skim_cache,
+                      dtypes=dtypes)
+
+        if references is not None:
+            missing.extend("%s['%s']" % (local_name, key)
+                           for key in sorted(references[local_name])
+                           if key not in skims.matrices)
 
         skims_dict[local_name] = skims
 
+    if missing:
+        close_skims(skims_dict)
+        raise RuntimeError("skims %s not found in %s" % (missing, SKIMS_KEY))
+
+    if references is not None and skims_dict and prefetch \
+            and model_settings.get(PREFETCH_KEY, True):
+        budget = skim_cache.max_bytes
+        prefetch_keys = {}
+        for local_name, skims in skims_dict.items():
+            keys = prefetch_keys[local_name] = []
+            for key in references[local_name]:
+                if budget is not None:
+                    budget -= skims.nbytes(key)
+                    if budget < 0:
+                        break
+                keys.append(key)
+
+        for local_name, skims in skims_dict.items():
+            skims.prefetch(prefetch_keys[local_name])
+
     return skims_dict
 
 
+def skims_block(skims_dict, rows):
+    """Restrict each Skims object to a block of origin zones
+
+    Parameters
+    ----------
+    skims_dict : dict of Skims objects
+    rows : slice
+        origin zone positions
+
+    Returns
+    -------
+    dictionary of SkimsBlock objects
+    """
+    return {local_name: skims.block(rows) for local_name, skims in skims_dict.items()}
+
+
+def skims_pairs(skims_dict, orig_pos, dest_pos):
+    """Restrict each Skims or SkimsBlock object to selected orig, dest pairs
+
+    Other values in skims_dict, such as constants, are skipped.
+
+    Parameters
+    ----------
+    skims_dict : dict containing Skims or SkimsBlock objects
+    orig_pos : numpy array
+    dest_pos : numpy array
+
+    Returns
+    -------
+    dictionary of SkimsPairs objects
+    """
+    return {local_name: SkimsPairs(skims, orig_pos, dest_pos)
+            for local_name, skims in skims_dict.items()
+            if isinstance(skims, (Skims, SkimsBlock))}
+
+
+def pin_skims(skims_dict, references):
+    """Read the referenced skims and keep them in memory, see Skims.pin
+
+    Parameters
+    ----------
+    skims_dict : dict containing Skims objects
+    references : dict
+        local name: keys used by the expressions
+    """
+    for local_name, val in skims_dict.items():
+        if isinstance(val, Skims):
+            val.pin(sorted(references.get(local_name, [])))
+
+
+def wait_skims(locals_dict):
+    """Wait for skims being read in the background, e.g. before forking"""
+    for val in locals_dict.values():
+        if isinstance(val, Skims):
+            val.wait()
+
+
 def close_skims(locals_dict):
     for local_name, val in locals_dict.items():
         if isinstance(val, Skims):
@@ -49,14 +194,134 @@ def close_skims(locals_dict):
             val.close()
 
 
+def read_subset(node, indices, col_indices=None):
+    """Rows and columns indices of a square omx matrix
+
+    Contiguous index ranges, such as zones matching the omx file one to
+    one, are read with a single slice. Otherwise rows are read in blocks
+    aligned to the HDF5 chunks, spanning only the columns from the lowest
+    to the highest index, and the wanted rows and columns are taken from
+    each block. Blocks without any wanted rows are not read.
+
+    Parameters
+    ----------
+    node : omx matrix (pytables CArray), zarr array or numpy array
+    indices : numpy array
+        zero-based omx positions of the zones, in zone order
+    col_indices : numpy array, optional
+        omx positions of the columns, if not the same as the rows,
+        e.g. to read the rows of a block of origin zones
+
+    Returns
+    -------
+    2D C-contiguous array
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    col_indices = indices if col_indices is None else np.asarray(col_indices, dtype=np.int64)
+    num_rows, num_cols = len(indices), len(col_indices)
+    if not num_rows or not num_cols:
+        return np.zeros((num_rows, num_cols), dtype=node.dtype)
+
+    start, col_start = indices[0], col_indices[0]
+    if np.array_equal(indices, np.arange(start, start + num_rows)) \
+            and np.array_equal(col_indices, np.arange(col_start, col_start + num_cols)):
+        return np.ascontiguousarray(node[start:start + num_rows, col_start:col_start + num_cols])
+
+    lo, hi = col_indices.min(), col_indices.max() + 1
+    cols = col_indices - lo
+
+    chunkshape = getattr(node, 'chunkshape', getattr(node, 'chunks', None))
+    chunk_rows = chunkshape[0] if chunkshape else 1
+    block_rows = READ_BLOCK_BYTES // ((hi - lo) * node.dtype.itemsize)
+    block_rows = max(chunk_rows, block_rows // chunk_rows * chunk_rows)
+
+    order = np.argsort(indices, kind='stable')
+    sorted_rows = indices[order]
+    row_lo, row_hi = sorted_rows[0], sorted_rows[-1] + 1
+
+    data = np.empty((num_rows, num_cols), dtype=node.dtype)
+    for block_start in range(row_lo - row_lo % chunk_rows, row_hi, block_rows):
+        block_stop = min(block_start + block_rows, row_hi)
+        i, j = np.searchsorted(sorted_rows, [block_start, block_stop])
+        if i == j:
+            continue
+        block = node[block_start:block_stop, lo:hi]
+        data[order[i:j]] = np.take(block[sorted_rows[i:j] - block_start], cols, axis=1)
+
+    return data
+
+
+class SkimCache(object):
+    """Skim matrices read so far, dropping the least recently used
+    beyond a memory budget
+
+    Dropped skims are read again, from the omx file or the skim cache
+    files, the next time they are used.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        memory budget. The most recently used skim is always kept,
+        even if it alone exceeds the budget, and so are pinned skims.
+        Unbounded if None.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.arrays = OrderedDict()
+
+        # keys that are never dropped, see Skims.pin
+        self.pinned = set()
+
+    def __contains__(self, key):
+        return key in self.arrays
+
+    def __getitem__(self, key):
+        self.arrays.move_to_end(key)
+        return self.arrays[key]
+
+    def __setitem__(self, key, data):
+        if key in self.arrays:
+            self.nbytes -= self.arrays.pop(key).nbytes
+        self.arrays[key] = data
+        self.nbytes += data.nbytes
+
+        for evicted in list(self.arrays)[:-1]:
+            if self.max_bytes is None or self.nbytes <= self.max_bytes:
+                break
+            if evicted in self.pinned:
+                continue
+            self.nbytes -= self.arrays.pop(evicted).nbytes
+            logger.debug("dropped skim %s from skim cache" % (evicted, ))
+
+    def clear(self, keys):
+        for key in keys:
+            self.pinned.discard(key)
+            if key in self.arrays:
+                self.nbytes -= self.arrays.pop(key).nbytes
+
+
 class Skims(object):
 
-    def __init__(self, name, omx_file_path, zone_index):
+    def __init__(self, name, omx_file_path, zone_index, dense=False, cache=False,
+                 skim_cache=None, dtypes=None):
 
         self.name = name
-        self.skims_dict = {}
-
-        self.omx = omx.open_file(omx_file_path, 'r')
+        self.dense = dense
+        self.cache = cache
+        self.skim_cache = SkimCache() if skim_cache is None else skim_cache
+        self.dtypes = dtypes or {}
+        self.used = set()
+        self.omx_file_path = omx_file_path
+        self._cache_key = None
+
+        # skims being read in the background, see prefetch
+        self._futures = {}
+        self._executor = None
+        self._read_lock = threading.Lock()
+
+        self.omx = skim_files.open_skims_file(omx_file_path)
         self.omx_shape = tuple([int(s) for s in self.omx.shape()])
         self.matrices = self.omx.listMatrices()
 
@@ -92,44 +357,259 @@ class Skims(object):
             self.offset_mapper.set_offset_int(1)
 
     def __getitem__(self, key):
-        """accessor to return pandas Series with specified key
+        """accessor to return skim array with specified key
 
-        this allows the skim series (with a useable index) to be
-        accessed from expressions as skim['DISTANCE']
+        this allows the skim array to be accessed from expressions
+        as skim['DISTANCE']. Arrays are 2D orig x dest matrices for
+        dense skims and flattened (orig-major) otherwise.
 
-        also caches series as a column in self.skims_dict
+        also caches the matrix in self.skim_cache
+        """
+
+        omx_data = self.matrix(key)
+
+        return omx_data if self.dense else omx_data.ravel()
+
+    def matrix(self, key):
+        """2D orig x dest skim matrix with specified key, read on first access
         """
 
         assert key in self.matrices
 
-        if key in self.skims_dict:
-            omx_data = self.skims_dict[key]
+        cache_key = (self.name, key)
+        if cache_key in self.skim_cache:
+            omx_data = self.skim_cache[cache_key]
+        elif key in self._futures:
+            omx_data = self._futures.pop(key).result()
+            self.skim_cache[cache_key] = omx_data
         else:
-            omx_data = self.read_from_omx(key)
-            self.skims_dict[key] = omx_data
+            omx_data = self._read(key)
+            self.skim_cache[cache_key] = omx_data
+
+        self.used.add(key)
 
         return omx_data
 
+    def nbytes(self, key):
+        """Memory used by the skim with specified key once read"""
+        dtype = self.dtypes.get(key, self.omx[key].dtype)
+        return len(self.omx_indices) ** 2 * np.dtype(dtype).itemsize
+
+    def _read(self, key):
+        # pytables file handles are not safe to share between threads
+        with self._read_lock:
+            return self.read_cached(key) if self.cache else self.read_from_omx(key)
+
+    def prefetch(self, keys):
+        """Start reading skims in a background thread
+
+        Skims are read one at a time, in the given order, since the omx
+        file handle is not shared between threads. matrix waits for a
+        skim still being read.
+
+        Parameters
+        ----------
+        keys : list of str
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1,
+                                                thread_name_prefix='skims_%s' % self.name)
+        for key in keys:
+            if (self.name, key) not in self.skim_cache and key not in self._futures:
+                self._futures[key] = self._executor.submit(self._read, key)
+
+    def wait(self):
+        """Finish reading any skims being read in the background"""
+        for key in list(self._futures):
+            self.skim_cache[(self.name, key)] = self._futures.pop(key).result()
+
+    def pin(self, keys):
+        """Read skims and keep them in memory, even beyond max_skim_memory_mb
+
+        Used before forking worker processes, which must not read from
+        the omx file handle they inherit, since HDF5 file handles are not
+        fork safe. Skims in .npy directories and zarr stores, which
+        workers can read themselves, are not read.
+
+        Parameters
+        ----------
+        keys : list of str
+        """
+        if getattr(self.omx, 'reads_row_blocks', False):
+            return
+
+        for key in keys:
+            self.skim_cache.pinned.add((self.name, key))
+            self.matrix(key)
+
+        max_bytes = self.skim_cache.max_bytes
+        if max_bytes is not None and self.skim_cache.nbytes > max_bytes:
+            logger.warning("skims kept in memory for worker processes use %.1f MB, more than "
+                           "%s" % (self.skim_cache.nbytes / 2**20, MAX_SKIM_MEMORY_KEY))
+
+    def reads_row_blocks(self, key):
+        """Whether SkimsBlock should read its rows of the skim with specified
+        key from the file, rather than slice them from the whole matrix
+
+        That is when the file reads a block of rows without reading the
+        others, see skim_files, and the whole matrix is neither in memory
+        nor being read.
+        """
+        return getattr(self.omx, 'reads_row_blocks', False) and not self.cache \
+            and (self.name, key) not in self.skim_cache and key not in self._futures
+
+    def block(self, rows):
+        return SkimsBlock(self, rows)
+
     def read_from_omx(self, key):
         """selects only the rows and columns that match the od_index to
-        avoid unnecessarily reading potentially large matrices into memory
+        avoid unnecessarily reading potentially large matrices into memory,
+        see read_subset
+
+        Skims are converted to their type in skim_dtypes, if any.
 
         Returns
         -------
-        flattened 2D array
+        2D array
         """
-        try:
-            data = self.omx[key][self.omx_indices, :][:, self.omx_indices]
-        except omx.tables.exceptions.NoSuchNodeError:
+        return self._read_subset(key, self.omx_indices)
+
+    def read_rows(self, key, rows):
+        """read_from_omx for only the rows of a block of origin zones
+
+        Parameters
+        ----------
+        key : str
+        rows : slice
+            origin zone positions
+
+        Returns
+        -------
+        2D block rows x dest array
+        """
+        self.used.add(key)
+        return self._read_subset(key, self.omx_indices[rows])
+
+    def _read_subset(self, key, row_indices):
+        if key not in self.matrices:
             raise RuntimeError("Could not find skim with key '%s' in %s" % (key, self.name))
+        node = self.omx[key]
+
+        data = read_subset(node, row_indices, self.omx_indices)
 
-        return data.flatten()
+        if key in self.dtypes:
+            data = data.astype(self.dtypes[key], copy=False)
+
+        return data
+
+    def read_cached(self, key):
+        """read_from_omx through a cache of memory-mapped .npy files
+
+        Each core is read from the omx file once, already subset and
+        ordered to the zone index, and saved to the cache directory.
+        Later reads, and other processes on the same machine, map the
+        file instead, so the data is shared through the page cache and
+        never decompressed again. Cache files are keyed by the content
+        hash of the omx file (rehashed only when its size or modification
+        time changes), the zone index mapping, the core name and its type.
+
+        Returns
+        -------
+        2D read-only array
+        """
+        if self._cache_key is None:
+            h = hashlib.sha256(cache.cached_file_digest(self.omx_file_path).encode('utf-8'))
+            h.update(np.asarray(self.omx_indices, dtype=np.int64).tobytes())
+            self._cache_key = h.hexdigest()
+
+        dtype = self.dtypes.get(key, '')
+        key_hash = hashlib.sha256(('%s\0%s\0%s' % (self._cache_key, key, dtype)).encode('utf-8'))
+        file_path = path.join(cache.cache_dir(SKIM_CACHE_DIR), '%s.npy' % key_hash.hexdigest())
+
+        if not path.isfile(file_path):
+            data = self.read_from_omx(key)
+            cache.write_atomic(file_path, lambda f: np.save(f, np.ascontiguousarray(data)))
+            if not path.isfile(file_path):
+                return data
+            logger.info("cached skim '%s' from %s in %s" % (key, self.name, file_path))
+
+        return np.load(file_path, mmap_mode='r')
 
     def close(self):
 
-        unused_skims = list(set(self.matrices)-set(self.skims_dict.keys()))
+        for future in self._futures.values():
+            future.cancel()
+        self._futures = {}
+
+        unused_skims = list(set(self.matrices)-self.used)
         if unused_skims:
             logger.debug("Did not ever use skims %s in '%s'" % (unused_skims, self.name))
 
-        self.omx.close()
-        self.skims_dict = {}
+        # wait for a skim still being read
+        with self._read_lock:
+            self.omx.close()
+        self.skim_cache.clear([(self.name, key) for key in self.used])
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+class SkimsBlock(object):
+    """Origin zone rows of a Skims object
+
+    skims_block['DISTANCE'] returns only the rows for the block's origin
+    zones, shaped the same way as the parent Skims. Unless the whole
+    matrix is already in memory, skims files that can read a block of
+    rows on its own, such as .npy directories and zarr stores, are read
+    for the block's rows only, once per block.
+    """
+
+    def __init__(self, skims, rows):
+
+        self.skims = skims
+        self.rows = rows
+        self.block_arrays = {}
+
+    def __getitem__(self, key):
+
+        omx_data = self.matrix(key)
+
+        return omx_data if self.skims.dense else omx_data.ravel()
+
+    def matrix(self, key):
+        """2D block rows x dest skim matrix with specified key"""
+        if key in self.block_arrays:
+            return self.block_arrays[key]
+
+        if self.skims.reads_row_blocks(key):
+            self.block_arrays[key] = self.skims.read_rows(key, self.rows)
+            return self.block_arrays[key]
+
+        return self.skims.matrix(key)[self.rows]
+
+
+class SkimsPairs(object):
+    """Selected orig, dest pairs of a Skims or SkimsBlock object
+
+    skims_pairs['DISTANCE'] returns a 1D array with the skim value
+    of each pair.
+
+    Parameters
+    ----------
+    skims : Skims or SkimsBlock
+    orig_pos : numpy array
+        origin zone positions, relative to the rows of skims
+    dest_pos : numpy array
+        destination zone positions
+    """
+
+    def __init__(self, skims, orig_pos, dest_pos):
+
+        self.skims = skims
+        self.orig_pos = orig_pos
+        self.dest_pos = dest_pos
+
+    def __getitem__(self, key):
+
+        return self.skims.matrix(key)[self.orig_pos, self.dest_pos]
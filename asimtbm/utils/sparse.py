@@ -0,0 +1,323 @@
+import logging
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+AVAILABLE_KEY = 'available'
+DISTANCE_KEY = 'distance'
+MAX_DISTANCE_KEY = 'max_distance'
+NEAREST_KEY = 'nearest'
+SAMPLE_SIZE_KEY = 'size'
+PROPOSAL_KEY = 'proposal'
+SEED_KEY = 'seed'
+
+
+class ODPairs(object):
+    """Origin-destination pairs stored compressed by origin (CSR)
+
+    The destinations of origin i are dest_pos[indptr[i]:indptr[i + 1]],
+    in ascending order, so pairs are in the same orig-major order as a
+    dense orig x dest array with the missing pairs dropped.
+
+    Parameters
+    ----------
+    indptr : numpy array
+        length num orig + 1
+    dest_pos : numpy array
+        destination zone position of each pair
+    num_dest : int
+        number of destination zones
+    """
+
+    def __init__(self, indptr, dest_pos, num_dest):
+        self.indptr = indptr
+        self.dest_pos = dest_pos
+        self.num_dest = num_dest
+
+        self.counts = np.diff(indptr)
+        self.orig_pos = np.repeat(np.arange(len(self.counts)), self.counts)
+
+    @classmethod
+    def from_mask(cls, mask):
+        """Pairs where a 2D orig x dest boolean mask is true"""
+        orig_pos, dest_pos = np.nonzero(mask)
+
+        return cls.from_positions(orig_pos, dest_pos, mask.shape)
+
+    @classmethod
+    def from_positions(cls, orig_pos, dest_pos, shape):
+        """Pairs of orig, dest positions, sorted orig-major without duplicates"""
+        indptr = np.zeros(shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(orig_pos, minlength=shape[0]), out=indptr[1:])
+
+        return cls(indptr, dest_pos, shape[1])
+
+    @property
+    def num_orig(self):
+        return len(self.counts)
+
+    @property
+    def nnz(self):
+        return len(self.dest_pos)
+
+    def lookup(self, orig_pos, dest_pos):
+        """Pair numbers of the given orig, dest positions that are in the set
+
+        Returns
+        -------
+        numpy array of pair numbers
+        """
+        found = []
+        for o, d in zip(orig_pos, dest_pos):
+            start, stop = self.indptr[o], self.indptr[o + 1]
+            i = start + np.searchsorted(self.dest_pos[start:stop], d)
+            if i < stop and self.dest_pos[i] == d:
+                found.append(i)
+
+        return np.array(found, dtype=np.int64)
+
+    def reduce(self, ufunc, values, empty):
+        """Reduce pair values by origin, e.g. np.add for sums
+
+        Parameters
+        ----------
+        ufunc : numpy ufunc
+        values : [... x] num pairs numpy array
+        empty : value for origins without pairs
+
+        Returns
+        -------
+        [... x] num orig numpy array
+        """
+        nonempty = self.counts > 0
+        out = np.full(values.shape[:-1] + (self.num_orig, ), empty, dtype=values.dtype)
+        if nonempty.any():
+            out[..., nonempty] = ufunc.reduceat(values, self.indptr[:-1][nonempty], axis=-1)
+
+        return out
+
+    def expand(self, values):
+        """Repeat origin values for each of the origin's pairs"""
+        return np.repeat(values, self.counts, axis=-1)
+
+    def od_index(self, orig_index, dest_index):
+        """orig, dest MultiIndex of the pairs"""
+        return pd.MultiIndex.from_arrays([np.asanyarray(orig_index)[self.orig_pos],
+                                          np.asanyarray(dest_index)[self.dest_pos]],
+                                         names=['orig', 'dest'])
+
+
+class ZoneValues(object):
+    """Zone attribute accessor for expressions evaluated on a list of pairs,
+    such as ODPairs or the rows of a long-format OD table
+
+    zone_values['col'] returns the attribute of the origin (or
+    destination) zone of each pair. Only the requested column is
+    expanded, on each access.
+
+    Parameters
+    ----------
+    df : pandas DataFrame
+        zone attributes
+    positions : numpy array
+        row of df for each pair
+    """
+
+    def __init__(self, df, positions):
+        self.df = df
+        self.positions = positions
+
+    def __getitem__(self, key):
+        return self.df[key].values[self.positions]
+
+
+def choice_set(locals_dict, settings, shape):
+    """Available destinations of each origin zone in a block
+
+    Settings (all optional):
+
+        - available: expression that is true for available destinations,
+          e.g. dest_zone['totemp'] > 0
+        - distance: expression measuring distance to destinations,
+          e.g. skims['DIST']. Required by max_distance and nearest.
+        - max_distance: destinations further away are unavailable
+        - nearest: only this many of the closest available destinations
+          are kept. Destinations tied with the furthest kept one are
+          also kept.
+
+    Parameters
+    ----------
+    locals_dict : dict
+        constants, skims and zone vectors for dense evaluation
+    settings : dict
+    shape : tuple
+        (num orig zones, num dest zones)
+
+    Returns
+    -------
+    ODPairs
+    """
+    _locals_dict = {'np': np, 'pd': pd}
+    _locals_dict.update(locals_dict)
+
+    mask = np.ones(shape, dtype=bool)
+
+    available = settings.get(AVAILABLE_KEY)
+    if available:
+        mask &= np.broadcast_to(eval(available, {}, _locals_dict), shape).astype(bool)
+
+    max_distance = settings.get(MAX_DISTANCE_KEY)
+    nearest = settings.get(NEAREST_KEY)
+
+    if max_distance is not None or nearest:
+        if not settings.get(DISTANCE_KEY):
+            raise RuntimeError("choice set %s or %s requires a %s expression"
+                               % (MAX_DISTANCE_KEY, NEAREST_KEY, DISTANCE_KEY))
+        distance = np.broadcast_to(eval(settings[DISTANCE_KEY], {}, _locals_dict), shape)
+
+        if max_distance is not None:
+            mask &= distance <= max_distance
+
+        if nearest and nearest < shape[1]:
+            masked_distance = np.where(mask, distance, np.inf)
+            kth = np.partition(masked_distance, nearest - 1, axis=1)[:, nearest - 1]
+            mask &= masked_distance <= kth[:, np.newaxis]
+
+    pairs = ODPairs.from_mask(mask)
+    logger.debug('choice set keeps %s of %s od pairs' % (pairs.nnz, mask.size))
+
+    return pairs
+
+
+def sample_destinations(locals_dict, settings, orig_index, shape):
+    """Importance sample of destinations for each origin zone in a block
+
+    Each origin draws sample size destinations, with replacement, with
+    probabilities proportional to the proposal expression, a cheap
+    stand-in for the destination choice utility such as
+    dest_zone['totemp'] * np.exp(-0.1 * skims['DIST']). Destinations with
+    zero proposal weight are never drawn.
+
+    Each origin's draws are seeded by the seed setting and the origin
+    zone id, so samples do not depend on how origins are split into
+    blocks or processes.
+
+    The sampling correction log(count / (size * proposal probability)),
+    added to the utility of each sampled destination, makes the sum of
+    exponentiated utilities of the sample an unbiased estimate of the
+    full one. The sampled logsum is its log, so it is only consistent:
+    by Jensen's inequality it underestimates the full logsum, less so
+    with more draws. The sampled probabilities are consistent estimates
+    of the full choice probabilities.
+
+    Settings:
+
+        - size: number of draws per origin
+        - proposal: expression of nonnegative orig x dest weights
+        - seed: optional, default 0
+
+    Parameters
+    ----------
+    locals_dict : dict
+        constants, skims and zone vectors for dense evaluation
+    settings : dict
+    orig_index : pandas Index
+        origin zone ids of the block
+    shape : tuple
+        (num orig zones, num dest zones)
+
+    Returns
+    -------
+    pairs : ODPairs
+        the distinct sampled destinations
+    correction : numpy array
+        sampling correction for each pair
+    """
+    sample_size = settings.get(SAMPLE_SIZE_KEY)
+    if not settings.get(PROPOSAL_KEY) or not sample_size:
+        raise RuntimeError("destination sampling requires %s and %s"
+                           % (SAMPLE_SIZE_KEY, PROPOSAL_KEY))
+    seed = settings.get(SEED_KEY, 0)
+
+    _locals_dict = {'np': np, 'pd': pd}
+    _locals_dict.update(locals_dict)
+
+    weights = np.broadcast_to(eval(settings[PROPOSAL_KEY], {}, _locals_dict), shape)
+    if (weights < 0).any():
+        raise RuntimeError("destination sampling %s must not be negative" % PROPOSAL_KEY)
+
+    num_dest = shape[1]
+    cdf = np.cumsum(weights, axis=1)
+    totals = cdf[:, -1]
+
+    flat_pos = []
+    for i, zone in enumerate(orig_index):
+        if not totals[i] > 0:
+            continue
+        draws = np.random.default_rng([seed, int(zone)]).random(sample_size) * totals[i]
+        dest_pos = np.searchsorted(cdf[i], draws, side='right')
+        flat_pos.append(i * num_dest + np.minimum(dest_pos, num_dest - 1))
+
+    flat_pos, counts = np.unique(np.concatenate(flat_pos) if flat_pos else
+                                 np.zeros(0, dtype=np.int64), return_counts=True)
+    orig_pos, dest_pos = flat_pos // num_dest, flat_pos % num_dest
+
+    pairs = ODPairs.from_positions(orig_pos, dest_pos, shape)
+    probs = weights[orig_pos, dest_pos] / totals[orig_pos]
+    correction = np.log(counts / (sample_size * probs))
+
+    logger.debug('sampled %s of %s od pairs' % (pairs.nnz, np.prod(shape)))
+
+    return pairs, correction
+
+
+def sum_by_orig(od_arrays, pairs, orig_index):
+    """Sum each pair array over destinations
+
+    Parameters
+    ----------
+    od_arrays : dict
+        column name: num pairs array
+    pairs : ODPairs
+    orig_index : pandas Index
+        origin zone ids
+
+    Returns
+    -------
+    pandas DataFrame indexed by 'orig'
+    """
+    sums = OrderedDict()
+    for name, values in od_arrays.items():
+        values = np.asanyarray(values)
+        if values.dtype == bool:
+            values = values.astype(np.int64)
+        sums[name] = pairs.reduce(np.add, values, 0)
+
+    return pd.DataFrame(sums, index=pd.Index(orig_index, name='orig'))
+
+
+def sum_by_dest(od_arrays, pairs, dest_index):
+    """Sum each pair array over origins
+
+    Parameters
+    ----------
+    od_arrays : dict
+        column name: num pairs array
+    pairs : ODPairs
+    dest_index : pandas Index
+        destination zone ids
+
+    Returns
+    -------
+    pandas DataFrame indexed by 'dest'
+    """
+    sums = OrderedDict()
+    for name, values in od_arrays.items():
+        values = np.asanyarray(values)
+        total = np.bincount(pairs.dest_pos, weights=values, minlength=pairs.num_dest)
+        sums[name] = total if values.dtype.kind == 'f' else total.astype(np.int64)
+
+    return pd.DataFrame(sums, index=pd.Index(dest_index, name='dest'))
@@ -1,45 +1,222 @@
 import logging
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
 
 logger = logging.getLogger(__name__)
 
 
+def _zone_list(zones):
+    if zones is None or isinstance(zones, (list, tuple)):
+        return zones
+    return [zones]
+
+
+def parse_trace_od(trace_od):
+    """Split trace_od into the origin and destination zones of each trace
+
+    trace_od can be a single trace or a list of traces. Each trace is
+    either an [o, d] pair or a dict with keys 'o' and/or 'd', whose
+    values can be a zone or a list of zones. For example
+
+        trace_od:
+          - [3, 32]
+          - o: [5, 7]
+          - d: 12
+
+    traces the trip from 3 to 32, all trips originating in 5 or 7 and
+    all trips ending in 12.
+
+    Parameters
+    ----------
+    trace_od : list or dict
+
+    Returns
+    -------
+    list of (origin zones, destination zones) tuples
+        either of which may be None, meaning all zones
+    """
+    if not trace_od:
+        return []
+
+    if isinstance(trace_od, dict) or \
+            (isinstance(trace_od, list) and len(trace_od) == 2
+             and not any(isinstance(t, (list, dict)) for t in trace_od)):
+        trace_od = [trace_od]
+
+    if not isinstance(trace_od, list):
+        logger.warn("trace_od must be either a list or dict with keys 'o' and 'd'")
+        return []
+
+    traces = []
+    for t in trace_od:
+        if isinstance(t, list) and len(t) == 2:
+            o, d = t
+        elif isinstance(t, dict):
+            o, d = t.get('o'), t.get('d')
+        else:
+            logger.warn("failed to parse trace_od %s" % t)
+            continue
+
+        if o is None and d is None:
+            logger.warn("failed to parse trace_od %s" % t)
+            continue
+
+        traces.append((_zone_list(o), _zone_list(d)))
+
+    return traces
+
+
 def trace_filter(df, trace_od, orig='orig', dest='dest'):
     """Filter out rows from DataFrame matching the trace_od
 
     Chooses rows matching trace_od. Specify just 'o' to trace
     all trips originating in that zone, just 'd' to trace all
     trips ending on that zone, or both to trace the single trip
-    starting in 'o' and ending in 'd'.
+    starting in 'o' and ending in 'd'. See parse_trace_od for
+    tracing several zones or pairs.
+
+    This compares every row of df. trace_locs finds the rows of
+    a sorted orig, dest index without doing so.
 
     Parameters
     ----------
     df : pandas DataFrame with columns matching orig, dest
     trace_od : list or dict
-        list of length == 2 or dict with keys 'o', 'd'
+        see parse_trace_od
 
     Returns
     -------
     pandas Series or None
         non-indexed pandas filter. None if no trace_od or parsing error.
     """
-    if not trace_od:
+    traces = parse_trace_od(trace_od)
+    if not traces:
         return None
 
-    if isinstance(trace_od, list) and len(trace_od) == 2:
-        o, d = trace_od
-    elif isinstance(trace_od, dict):
-        o, d = trace_od.get('o'), trace_od.get('d')
-    else:
-        logger.warn("trace_od must be either a list or dict with keys 'o' and 'd'")
+    mask = pd.Series(False, index=df.index)
+    for o, d in traces:
+        match = pd.Series(True, index=df.index)
+        if o is not None:
+            match &= df.loc[:, orig].isin(o)
+        if d is not None:
+            match &= df.loc[:, dest].isin(d)
+        mask |= match
+
+    return mask
+
+
+def trace_locs(od_index, trace_od):
+    """Positions of the trace_od rows in an orig, dest MultiIndex
 
-    if o and d:
-        return (df.loc[:, orig] == o) & (df.loc[:, dest] == d)
+    Looks the zones up in the index, by binary search if it is
+    sorted, so there is no pass over every row. Traces with only a
+    destination zone, or an unsorted index, compare every row.
 
-    if o:
-        return df.loc[:, orig] == o
+    Parameters
+    ----------
+    od_index : pandas MultiIndex
+        origin zone level first, destination zone level second
+    trace_od : list or dict
+        see parse_trace_od
 
-    if d:
-        return df.loc[:, dest] == d
+    Returns
+    -------
+    numpy array or None
+        sorted row positions. None if no trace_od, parsing error or
+        no matching rows.
+    """
+    traces = parse_trace_od(trace_od)
+    if not traces:
+        return None
+
+    sorted_index = od_index.is_monotonic_increasing
+
+    locs = []
+    for o, d in traces:
+        if sorted_index and o is not None:
+            # pairs missing from the index give empty slices
+            for orig in o:
+                for key in ([(orig, dest) for dest in d] if d is not None else [(orig, )]):
+                    start, stop = od_index.slice_locs(key, key)
+                    locs.append(np.arange(start, stop))
+            continue
+
+        match = np.ones(len(od_index), dtype=bool)
+        for level, zones in enumerate([o, d]):
+            if zones is not None:
+                codes = od_index.levels[level].get_indexer(zones)
+                match &= np.isin(od_index.codes[level], codes[codes >= 0])
+        locs.append(np.flatnonzero(match))
+
+    locs = np.unique(np.concatenate(locs))
+
+    return locs if len(locs) else None
+
+
+def trace_positions(orig_index, dest_index, trace_od):
+    """Positional equivalent of trace_locs for dense orig x dest arrays
+
+    Parameters
+    ----------
+    orig_index : pandas Index
+        zone ids in the row order of the arrays
+    dest_index : pandas Index
+        zone ids in the column order of the arrays
+    trace_od : list or dict
+        see parse_trace_od
+
+    Returns
+    -------
+    tuple of (orig positions, dest positions) numpy arrays or None
+        usable as a fancy index into an orig x dest array, in orig-major
+        order. None if no trace_od, parsing error or no matching zones.
+    """
+    traces = parse_trace_od(trace_od)
+    if not traces:
+        return None
+
+    def positions(index, zones):
+        if zones is None:
+            return np.arange(len(index))
+        pos = index.get_indexer(zones)
+        return pos[pos >= 0]
+
+    num_dest = len(dest_index)
+    flat = [(positions(orig_index, o)[:, np.newaxis] * num_dest
+             + positions(dest_index, d)[np.newaxis, :]).ravel()
+            for o, d in traces]
+
+    # orig_pos * num_dest + dest_pos, so duplicates are dropped in orig-major order
+    flat = np.unique(np.concatenate(flat))
+    if not len(flat):
+        return None
+
+    return flat // num_dest, flat % num_dest
+
+
+def trace_frame(trace_pairs, orig_index, dest_index, trace_results):
+    """Combine dense trace results with the zone ids of trace_pairs
+
+    Parameters
+    ----------
+    trace_pairs : tuple of (orig positions, dest positions)
+    orig_index : pandas Index
+    dest_index : pandas Index
+    trace_results : dict
+        column name: values at trace_pairs
+
+    Returns
+    -------
+    pandas DataFrame with 'orig', 'dest' and trace_results columns
+    """
+    orig_pos, dest_pos = trace_pairs
+    trace_df = pd.DataFrame(OrderedDict([
+        ('orig', np.asanyarray(orig_index)[orig_pos]),
+        ('dest', np.asanyarray(dest_index)[dest_pos]),
+    ]))
+    for name, values in trace_results.items():
+        trace_df[name] = values
 
-    logger.warn("failed to parse trace_od %s" % trace_od)
-    return None
+    return trace_df
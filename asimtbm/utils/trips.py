@@ -1,14 +1,17 @@
 import logging
+from collections import OrderedDict
+
 import pandas as pd
 import numpy as np
 
-from activitysim.core import assign, tracing, pipeline
+from activitysim.core import assign
 from asimtbm.utils import tracing as trace
 
 logger = logging.getLogger(__name__)
 
 
-def calculate_num_trips(od_df, zones, spec, locals_dict, segments, trace_od=None):
+def calculate_num_trips(od_df, zones, spec, locals_dict, segments, trace_od=None,
+                        dtype=np.float64):
     """Calculate number of trips for each origin-destination zone pair for
     each segment.
 
@@ -17,40 +20,99 @@ def calculate_num_trips(od_df, zones, spec, locals_dict, segments, trace_od=None
     od_df : pandas DataFrame
         origin-destination DataFrame of target variables calculated
         from the expressions file
-    zones : pandas DataFrame, zones table
+    zones : pandas DataFrame, zones table rows for the origins in od_df
     spec : pandas DataFrame, assignment expressions
     locals_dict : dict
         dictionary of constants, etc.
     segments : dict
         dictionary of segments. key is segment name, value is
         corresponding column in zones table
-    trace_od : list or dict, origin-destination pair
+    trace_od : list or dict, origin-destination pairs to trace
+    dtype : numpy dtype
+        float type for utility calculations
 
     Returns
     -------
-    None
-        writes calculations trace and registers trips table to pipeline
+    trips_df : pandas DataFrame
+        trips for each segment
+    logsums : pandas DataFrame
+        logsum of each origin zone for each segment
+    traces : OrderedDict
+        trace file name: segment calculations for the trace_od rows
     """
     logger.info('calculating number of trips per segment ...')
-    trips_df = pd.DataFrame(index=od_df.index)
-    trace_rows = trace.trace_filter(trips_df.reset_index(), trace_od)
+    trace_rows = trace.trace_locs(od_df.index, trace_od)
+    traces = OrderedDict()
+
+    coeffs = segment_coeff_matrix(spec, locals_dict, segments, od_df.columns)
+    orig = od_df.index.get_level_values('orig')
+
+    def by_orig(values):
+        return pd.DataFrame(values, index=orig).groupby(level=0)
+
+    # utilities for every segment from a single (od pairs x targets) @
+    # (targets x segments) product instead of a copy of od_df per segment
+    utils = od_df.to_numpy(dtype=dtype) @ coeffs.astype(dtype)
+
+    # log-sum-exp: shift each origin's utilities by its maximum before exponentiating
+    max_utils = by_orig(utils).max()
+    max_utils = max_utils.where(np.isfinite(max_utils), 0)
+    utils -= max_utils.reindex(orig).to_numpy()
+    np.exp(utils, out=utils)
+
+    sum_utils = by_orig(utils).sum()
+    with np.errstate(divide='ignore'):
+        logsums = np.log(sum_utils) + max_utils
+    logsums.index.name = 'orig'
+    logsums.columns = list(segments.keys())
+
+    if trace_rows is not None:
+        trace_scale = np.exp(max_utils.reindex(orig[trace_rows]).to_numpy())
+        trace_utils = utils[trace_rows] * trace_scale
+        trace_sums = sum_utils.reindex(orig[trace_rows]).to_numpy() * trace_scale
+        for i, segment in enumerate(segments):
+            segment_od = apply_segment_coeffs(od_df.iloc[trace_rows], spec, locals_dict, segment)
+            segment_od['utils'] = trace_utils[:, i]
+            segment_od['sum_utils'] = trace_sums[:, i]
+            segment_od['probs'] = trace_utils[:, i] / trace_sums[:, i]
+            traces['segment_od_%s' % segment] = segment_od.reset_index()
 
-    for segment, trip_key in segments.items():
-        segment_od = apply_segment_coeffs(od_df, spec, locals_dict, segment)
-        trips = zones[trip_key]
+    # trips = util / sum_utils * orig_trips, scaled in place by origin.
+    # origins with no available destination get no trips.
+    orig_trips = zones[list(segments.values())].reindex(sum_utils.index).to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        factors = np.where(sum_utils > 0, orig_trips / sum_utils.to_numpy(), 0)
+    factors = pd.DataFrame(factors.astype(dtype), index=sum_utils.index)
+    utils *= factors.reindex(orig).to_numpy()
 
-        num_trips = logit(segment_od, trips, trace=trace_rows is not None)
+    trips_df = pd.DataFrame(utils, index=od_df.index, columns=list(segments.keys()))
 
-        trips_df[segment] = num_trips
+    return trips_df, logsums, traces
 
-        if trace_rows is not None:
-            logger.debug('writing segment %s trace' % segment)
-            trace_rows.index = od_df.index
-            tracing.write_csv(segment_od[trace_rows].reset_index(),
-                              file_name='segment_od_%s' % segment,
-                              transpose=False)
 
-    pipeline.replace_table('trips', trips_df)
+def segment_coeff_matrix(spec, locals_dict, segments, targets):
+    """Evaluated segment coefficients as a (targets x segments) array
+
+    Parameters
+    ----------
+    spec : pandas DataFrame, assignment expressions
+    locals_dict : dict
+        dictionary of constants, etc.
+    segments : dict
+        dictionary of segments
+    targets : list of str
+        target names, in row order
+
+    Returns
+    -------
+    numpy array
+    """
+    coeffs = np.empty((len(targets), len(segments)))
+    for i, segment in enumerate(segments):
+        evaluated_segment = evaluate_segment_coeffs(spec, locals_dict, segment)
+        coeffs[:, i] = [evaluated_segment[target] for target in targets]
+
+    return coeffs
 
 
 def apply_segment_coeffs(od_df, spec, locals_dict, segment):
@@ -72,13 +134,31 @@ def apply_segment_coeffs(od_df, spec, locals_dict, segment):
     """
     logger.debug('applying segment coefficients to %s' % segment)
 
-    coeffs = pd.Series(spec[segment].values, index=spec.target)
-    evaluated_segment = assign.evaluate_constants(coeffs, locals_dict)
+    evaluated_segment = evaluate_segment_coeffs(spec, locals_dict, segment)
     segment_od = od_df.multiply(evaluated_segment, axis=1)
 
     return segment_od
 
 
+def evaluate_segment_coeffs(spec, locals_dict, segment):
+    """Evaluate the segment coefficient column of the spec
+
+    Parameters
+    ----------
+    spec : pandas DataFrame, assignment expressions
+    locals_dict : dict
+        dictionary of constants, etc.
+    segment: str, segment name
+
+    Returns
+    -------
+    dict of target: coefficient value
+    """
+    coeffs = pd.Series(spec[segment].values, index=spec.target)
+
+    return assign.evaluate_constants(coeffs, locals_dict)
+
+
 def logit(df, trips_series, chooser_col='orig', trace=False):
     """Calculate number of trips taken between each origin-destination pair
     using a logit utility model
@@ -106,10 +186,218 @@ def logit(df, trips_series, chooser_col='orig', trace=False):
 
     if trace:
         df['utils'] = util
-        df['sum_utils'] = np.repeat(np.asanyarray(sum_util), len(sum_util.index))
+        df['sum_utils'] = sum_util.reindex(df.index, level=chooser_col).values
         df['probs'] = probs
 
     # Since the trips_series (length == number of zones) index aligns
     # with the probs (length == number of zones ^2) index,
     # pandas can correctly align the rows.
     return probs * trips_series
+
+
+def calculate_dense_trips(od_arrays, zones, spec, locals_dict, segments, trace_pairs=None,
+                          dtype=np.float64, pairs=None, correction=None):
+    """Dense equivalent of calculate_num_trips
+
+    Also calculates trips for a sparse choice set, when od_arrays hold
+    one value for each of the given pairs rather than orig x dest arrays.
+
+    Parameters
+    ----------
+    od_arrays : dict
+        target name: orig x dest array calculated from the expressions file
+    zones : pandas DataFrame, zones table rows for the origins in od_arrays
+    spec : pandas DataFrame, assignment expressions
+    locals_dict : dict
+        dictionary of constants, etc.
+    segments : dict
+        dictionary of segments. key is segment name, value is
+        corresponding column in zones table
+    trace_pairs : tuple of (orig positions, dest positions) or None
+        or, with pairs, tuple of (pair numbers, )
+    dtype : numpy dtype
+        float type for utility calculations
+    pairs : sparse.ODPairs, optional
+        choice set the od_arrays were evaluated on
+    correction : numpy array, optional
+        added to the utilities of every segment, such as the sampling
+        correction of sampled destinations
+
+    Returns
+    -------
+    trips_dict : OrderedDict
+        segment name: orig x dest (or num pairs) array of trips
+    logsums : pandas DataFrame
+        logsum of each origin zone for each segment
+    traces : OrderedDict
+        trace file name: OrderedDict of segment calculations at trace_pairs
+    """
+    logger.info('calculating number of trips per segment ...')
+
+    coeffs = segment_coeff_matrix(spec, locals_dict, segments, list(od_arrays.keys()))
+    utils = dense_utilities(od_arrays, coeffs, dtype=dtype)
+    if correction is not None:
+        utils += correction.astype(dtype)
+    orig_trips = zones[list(segments.values())].to_numpy().T
+
+    if pairs is None:
+        num_trips, logsums, trace_results = dense_logit(utils, orig_trips,
+                                                        trace_pairs=trace_pairs)
+    else:
+        num_trips, logsums, trace_results = sparse_logit(utils, orig_trips, pairs,
+                                                         trace_pairs=trace_pairs)
+
+    logsums = pd.DataFrame(logsums.T, index=pd.Index(zones.index, name='orig'),
+                           columns=list(segments.keys()))
+
+    trips_dict = OrderedDict()
+    traces = OrderedDict()
+    for i, segment in enumerate(segments):
+        trips_dict[segment] = num_trips[i]
+
+        if trace_results is not None:
+            segment_trace = OrderedDict(
+                (target, coeffs[t, i] * values[trace_pairs])
+                for t, (target, values) in enumerate(od_arrays.items()))
+            segment_trace.update((name, values[i]) for name, values in trace_results.items())
+            traces['segment_od_%s' % segment] = segment_trace
+
+    return trips_dict, logsums, traces
+
+
+def dense_utilities(od_arrays, coeffs, dtype=np.float64):
+    """Utilities for every segment: the sum of coefficient * target over all targets
+
+    Accumulates into one utility array per segment, reusing a single
+    scratch array for the products.
+
+    Parameters
+    ----------
+    od_arrays : dict
+        target name: orig x dest array
+    coeffs : numpy array
+        (targets x segments) coefficients, targets in od_arrays order
+    dtype : numpy dtype
+        float type of the utilities
+
+    Returns
+    -------
+    segments x orig x dest numpy array
+    """
+    shape = np.shape(next(iter(od_arrays.values())))
+    utils = np.zeros((coeffs.shape[1], ) + shape, dtype=dtype)
+    scratch = np.empty(shape, dtype=dtype)
+    coeffs = coeffs.astype(dtype)
+
+    for t, values in enumerate(od_arrays.values()):
+        for i in range(coeffs.shape[1]):
+            np.multiply(values, coeffs[t, i], out=scratch)
+            utils[i] += scratch
+
+    return utils
+
+
+def dense_logit(utils, orig_trips, trace_pairs=None):
+    """Dense equivalent of logit
+
+    The last two axes of utils are origin and destination zones, so
+    probabilities are normalized along the last axis. Any leading
+    axes, such as segments, are calculated together.
+
+    Uses log-sum-exp, shifting each origin's utilities by their maximum
+    before exponentiating, so large utilities do not overflow and rows
+    of very negative utilities do not all underflow to zero. utils is
+    overwritten in place and returned as the number of trips. Origins
+    with no available destination get no trips and a logsum of -inf.
+
+    Parameters
+    ----------
+    utils : [segments x] orig x dest numpy array
+    orig_trips : [segments x] orig numpy array
+        number of trips originating from each zone, in row order
+    trace_pairs : tuple of (orig positions, dest positions) or None
+
+    Returns
+    -------
+    num_trips : [segments x] orig x dest numpy array
+        utils, overwritten
+    logsums : [segments x] orig numpy array
+    trace_results : OrderedDict or None
+        utility and probability calculations at trace_pairs
+    """
+    max_utils = utils.max(axis=-1, keepdims=True)
+    max_utils[~np.isfinite(max_utils)] = 0
+
+    utils -= max_utils
+    np.exp(utils, out=utils)
+    sum_utils = utils.sum(axis=-1, keepdims=True)
+
+    with np.errstate(divide='ignore'):
+        logsums = (np.log(sum_utils) + max_utils)[..., 0]
+
+    trace_results = None
+    if trace_pairs is not None:
+        orig_pos, dest_pos = trace_pairs
+        scale = np.exp(max_utils[..., orig_pos, 0])
+        trace_utils = utils[..., orig_pos, dest_pos] * scale
+        trace_sums = sum_utils[..., orig_pos, 0] * scale
+        trace_results = OrderedDict([
+            ('utils', trace_utils),
+            ('sum_utils', trace_sums),
+            ('probs', trace_utils / trace_sums),
+        ])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        factors = np.where(sum_utils > 0, orig_trips[..., np.newaxis] / sum_utils, 0)
+    utils *= factors.astype(utils.dtype)
+
+    return utils, logsums, trace_results
+
+
+def sparse_logit(utils, orig_trips, pairs, trace_pairs=None):
+    """dense_logit for utilities of a sparse choice set
+
+    Parameters
+    ----------
+    utils : [segments x] num pairs numpy array
+    orig_trips : [segments x] orig numpy array
+        number of trips originating from each zone, in row order
+    pairs : sparse.ODPairs
+    trace_pairs : tuple of (pair numbers, ) or None
+
+    Returns
+    -------
+    num_trips : [segments x] num pairs numpy array
+        utils, overwritten
+    logsums : [segments x] orig numpy array
+    trace_results : OrderedDict or None
+        utility and probability calculations at trace_pairs
+    """
+    max_utils = pairs.reduce(np.maximum, utils, -np.inf)
+    max_utils[~np.isfinite(max_utils)] = 0
+
+    utils -= pairs.expand(max_utils)
+    np.exp(utils, out=utils)
+    sum_utils = pairs.reduce(np.add, utils, 0)
+
+    with np.errstate(divide='ignore'):
+        logsums = np.log(sum_utils) + max_utils
+
+    trace_results = None
+    if trace_pairs is not None:
+        pair_num, = trace_pairs
+        orig_pos = pairs.orig_pos[pair_num]
+        scale = np.exp(max_utils[..., orig_pos])
+        trace_utils = utils[..., pair_num] * scale
+        trace_sums = sum_utils[..., orig_pos] * scale
+        trace_results = OrderedDict([
+            ('utils', trace_utils),
+            ('sum_utils', trace_sums),
+            ('probs', trace_utils / trace_sums),
+        ])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        factors = np.where(sum_utils > 0, orig_trips / sum_utils, 0)
+    utils *= pairs.expand(factors.astype(utils.dtype))
+
+    return utils, logsums, trace_results
@@ -0,0 +1,49 @@
+import logging
+
+from activitysim.core import config
+
+logger = logging.getLogger(__name__)
+
+# step name: (model settings file name, zone_columns(model_settings) function)
+_ZONE_COLUMNS = {}
+
+
+def register_zone_columns(step_name, yaml_file_name):
+    """Decorator registering the function that returns the zone table
+    columns a step uses, given the step's model settings
+
+    The zones table reads only the columns of the steps in the models
+    setting, see referenced_zone_columns, without importing the steps.
+
+    Parameters
+    ----------
+    step_name : str
+    yaml_file_name : str
+        model settings file of the step
+    """
+    def decorator(func):
+        _ZONE_COLUMNS[step_name] = (yaml_file_name, func)
+        return func
+
+    return decorator
+
+
+def referenced_zone_columns(models):
+    """Zone columns used by the steps in models
+
+    Parameters
+    ----------
+    models : list of step names
+
+    Returns
+    -------
+    set of column names
+    """
+    columns = set()
+    for step_name, (yaml_file_name, zone_columns) in _ZONE_COLUMNS.items():
+        if step_name in models:
+            columns.update(zone_columns(config.read_model_settings(yaml_file_name)))
+
+    logger.info('zone columns used by models: %s' % sorted(columns))
+
+    return columns
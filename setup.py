@@ -24,10 +24,9 @@ setup(
     include_package_data=True,
     python_requires=">=3.5.3",
     install_requires=[
-        'numpy >= 1.16.1',
+        'numpy >= 1.17',
         'openmatrix >= 0.3.4.1',
         'pandas >= 0.24.1',
-        'activitysim >= 0.9.1',
-        'ipfn >= 1.3.0'
+        'activitysim >= 0.9.1'
     ]
 )